@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the services. Each subcommand measures one part of the system
+# and prints a small report; run ./bench.py --help for the list.
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+import uuid
+
+import httpx
+import redis
+
+import gamecodec
+import shard
+import shardrouter
+import streakindex
+import userstats
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p95_ms": round(percentile(samples, 95), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+    }
+
+
+def load_words(path):
+    with open(path) as f:
+        return re.findall(r"VALUES\('([a-z]{5})'\)", f.read())
+
+
+def load_user_ids(database):
+    connection = sqlite3.connect(database)
+    user_ids = [str(uuid.UUID(bytes_le=row[0])) for row in connection.execute("SELECT user_id FROM users")]
+    connection.close()
+    return user_ids
+
+
+def load_usernames(database):
+    connection = sqlite3.connect(database)
+    usernames = [row[0] for row in connection.execute("SELECT username FROM users")]
+    connection.close()
+    return usernames
+
+
+# Play games through one req.py deployment, timing every /guess
+def play_sessions(url, sessions, words, usernames):
+    latencies = []
+    errors = 0
+    with httpx.Client(base_url=url, timeout=10.0) as client:
+        for _ in range(sessions):
+            r = client.post('/new', params={'username': random.choice(usernames)})
+            if r.is_error:
+                errors += 1
+                continue
+            game = r.json()
+            for _ in range(6):
+                params = {'user_id': game['user_id'], 'game_id': game['game_id'], 'guess': random.choice(words)}
+                start = time.perf_counter()
+                r = client.post('/guess', params=params)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if r.is_error:
+                    errors += 1
+    return latencies, errors
+
+
+def bench_modes(args):
+    words = load_words(args.words)
+    usernames = load_usernames(args.users)
+    print(f"{'mode':<12}{'guesses':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for mode, url in [('http', args.http_url), ('colocated', args.colocated_url)]:
+        latencies, errors = play_sessions(url, args.sessions, words, usernames)
+        stats = summarize(latencies)
+        print(f"{mode:<12}{stats['count']:>10}{stats['p50_ms']:>10}{stats['p99_ms']:>10}{errors:>8}")
+
+
+# A stats.db like the one shard.py splits, with random games
+def make_stats_database(path, users, games_per_user):
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE users(user_id INTEGER PRIMARY KEY, username VARCHAR UNIQUE)')
+    connection.execute('CREATE TABLE games(user_id INTEGER NOT NULL, game_id INTEGER NOT NULL, '
+                       'finished DATE, guesses INTEGER, won BOOLEAN, PRIMARY KEY(user_id, game_id))')
+    connection.executemany('INSERT INTO users VALUES (?,?)', ((i, f'user{i}') for i in range(1, users + 1)))
+    first_day = datetime.date(2022, 1, 1)
+    connection.executemany(
+        'INSERT INTO games VALUES (?,?,?,?,?)',
+        (
+            (user, game_id, first_day + datetime.timedelta(days=game_id), random.randint(1, 6), random.random() < 0.7)
+            for user in range(1, users + 1)
+            for game_id in random.sample(range(1, 2300), games_per_user)
+        )
+    )
+    connection.commit()
+    connection.close()
+
+
+# The original loader: one INSERT per game on a single thread, then the
+# user summaries
+def load_row_by_row(source, map_key, router):
+    connections = [sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES) for database in router.databases]
+    start = time.perf_counter()
+    game_connection = sqlite3.connect(source)
+    loaded = 0
+    for game in game_connection.execute("SELECT * FROM games"):
+        new_user_id = map_key[game[0]]
+        connections[router.shard_for(new_user_id) - 1].execute(
+            'INSERT INTO games VALUES (?,?,?,?,?)', [new_user_id, game[1], game[2], game[3], game[4]])
+        loaded += 1
+    for connection in connections:
+        userstats.rebuild(connection)
+        connection.commit()
+        connection.close()
+    game_connection.close()
+    return loaded, time.perf_counter() - start
+
+
+def bench_shard_load(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'stats.db')
+        make_stats_database(source, args.users, args.games_per_user)
+
+        results = {}
+        for method in ['row-by-row', 'pipeline']:
+            router = shardrouter.ShardRouter.from_template(os.path.join(tmp, method + '-games{}.db'), args.shards)
+            with contextlib.redirect_stdout(None):
+                connection = sqlite3.connect(source)
+                map_key = shard.create_user_database(connection.execute("SELECT * FROM users"),
+                                                     os.path.join(tmp, method + '-users.db'))
+                connection.close()
+                for database in router.databases:
+                    shard.create_sharding_games(database, indexes=(method == 'row-by-row'))
+                if method == 'row-by-row':
+                    results[method] = load_row_by_row(source, map_key, router)
+                else:
+                    results[method] = shard.shard_games(source, map_key, router, args.chunk_size, args.workers)
+
+    print(f"{'method':<12}{'rows':>12}{'seconds':>10}{'rows/sec':>14}")
+    for method, (rows, elapsed) in results.items():
+        print(f"{method:<12}{rows:>12}{elapsed:>10.2f}{rows / elapsed:>14,.0f}")
+
+
+# Games for existing users, with game ids well above the ones already played
+def make_posted_games(user_ids, count, first_game_id):
+    first_day = datetime.date(2022, 1, 1)
+    return [
+        {
+            "user_id": random.choice(user_ids),
+            "game_id": first_game_id + i,
+            "finished": (first_day + datetime.timedelta(days=random.randint(0, 900))).isoformat(),
+            "guesses": random.randint(1, 6),
+            "won": random.random() < 0.7,
+        }
+        for i in range(count)
+    ]
+
+
+def bench_ingest(args):
+    user_ids = load_user_ids(args.users)
+    first_game_id = random.randint(10 ** 6, 10 ** 9)
+    single = make_posted_games(user_ids, args.games, first_game_id)
+    bulk = make_posted_games(user_ids, args.games, first_game_id + args.games)
+
+    results = {}
+    with httpx.Client(base_url=args.url, timeout=60.0) as client:
+        start = time.perf_counter()
+        errors = sum(client.post('/games/', json=game).is_error for game in single)
+        results['single'] = (len(single), errors, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        errors = 0
+        for i in range(0, len(bulk), args.batch_size):
+            body = "\n".join(json.dumps(game) for game in bulk[i:i + args.batch_size])
+            r = client.post('/games/bulk', content=body, headers={'Content-Type': 'application/x-ndjson'})
+            errors += r.json()['failed'] if r.status_code == 200 else args.batch_size
+        results['bulk'] = (len(bulk), errors, time.perf_counter() - start)
+
+    print(f"{'method':<10}{'games':>10}{'errors':>8}{'seconds':>10}{'games/sec':>12}")
+    for method, (games, errors, elapsed) in results.items():
+        print(f"{method:<10}{games:>10}{errors:>8}{elapsed:>10.2f}{games / elapsed:>12,.0f}")
+    print(f"\nspeedup: {results['single'][2] / results['bulk'][2]:.1f}x")
+
+
+# Games in progress with between zero and six guesses
+def make_games_in_progress(count, words):
+    for game_id in range(count):
+        guesses = random.randint(0, 6)
+        game = {"user_id": str(uuid.uuid4()), "game_id": game_id}
+        for n in range(1, 7):
+            game[f'guess{n}'] = random.choice(words) if n <= guesses else None
+        game["remain_guess"] = 6 - guesses
+        yield game
+
+
+# Ways a game has been stored in Redis, as the pipeline command writing it
+GAME_FORMATS = {
+    'json': lambda pipe, key, game: pipe.set(key, json.dumps(game)),
+    'hash': lambda pipe, key, game: pipe.hset(key, mapping={k: v for k, v in game.items() if v is not None}),
+    'packed': lambda pipe, key, game: pipe.set(key, gamecodec.encode(game)),
+}
+
+# Size of the value each format writes, before Redis adds its own overhead
+GAME_SIZES = {
+    'json': lambda game: len(json.dumps(game)),
+    'hash': lambda game: sum(len(k) + len(str(v)) for k, v in game.items() if v is not None),
+    'packed': lambda game: len(gamecodec.encode(game)),
+}
+
+
+def used_memory(client_redis):
+    return client_redis.info('memory')['used_memory']
+
+
+def bench_codec(args):
+    client_redis = redis.Redis.from_url(args.redis_url)
+    games = list(make_games_in_progress(args.games, load_words(args.words)))
+
+    start = time.perf_counter()
+    for game in games:
+        gamecodec.decode(gamecodec.encode(game))
+    packed_us = (time.perf_counter() - start) / len(games) * 1e6
+    start = time.perf_counter()
+    for game in games:
+        json.loads(json.dumps(game))
+    json_us = (time.perf_counter() - start) / len(games) * 1e6
+
+    print(f"Measured on {args.redis_url}: bytes/game is the growth of INFO used_memory per game, key bytes")
+    print("the mean MEMORY USAGE of a sample of keys, and value bytes the mean serialized size\n")
+    print(f"{'format':<10}{'games':>10}{'bytes/game':>12}{'key bytes':>11}{'value bytes':>13}{'codec us':>10}")
+    for name, write in GAME_FORMATS.items():
+        prefix = f"bench:codec:{name}:"
+        before = used_memory(client_redis)
+        pipe = client_redis.pipeline(transaction=False)
+        for i, game in enumerate(games):
+            write(pipe, f"{prefix}{game['user_id']}{game['game_id']}", game)
+            if i % 10000 == 9999:
+                pipe.execute()
+        pipe.execute()
+        per_game = (used_memory(client_redis) - before) / len(games)
+
+        sample = random.sample(games, min(1000, len(games)))
+        usage = sum(
+            client_redis.memory_usage(f"{prefix}{game['user_id']}{game['game_id']}") for game in sample
+        ) / len(sample)
+        value = sum(GAME_SIZES[name](game) for game in sample) / len(sample)
+        codec = {'json': json_us, 'packed': packed_us}.get(name)
+
+        for i in range(0, len(games), 10000):
+            client_redis.delete(*(f"{prefix}{game['user_id']}{game['game_id']}" for game in games[i:i + 10000]))
+        print(f"{name:<10}{len(games):>10}{per_game:>12,.0f}{usage:>11,.0f}{value:>13,.0f}{'' if codec is None else f'{codec:.2f}':>10}")
+
+
+# The streaks view shard.py used to create, kept here to compare against
+STREAKS_VIEW = '''
+CREATE VIEW streaks AS
+WITH ranks AS (
+    SELECT DISTINCT user_id, finished, RANK() OVER(PARTITION BY user_id ORDER BY finished) AS rank
+    FROM games WHERE won = TRUE ORDER BY user_id, finished
+),
+groups AS (
+    SELECT user_id, finished, rank, DATE(finished, '-' || rank || ' DAYS') AS base_date FROM ranks
+)
+SELECT user_id, COUNT(*) AS streak, MIN(finished) AS beginning, MAX(finished) AS ending
+FROM groups GROUP BY user_id, base_date HAVING streak > 1 ORDER BY user_id, finished;
+'''
+
+
+# Games on mostly consecutive days, so users build up streaks
+def make_streak_games(users, games):
+    first_day = datetime.date(2022, 1, 1)
+    per_user = max(1, games // len(users))
+    for user_id in users:
+        day = random.randint(0, 365)
+        for game_id in range(1, per_user + 1):
+            day += 1 if random.random() < 0.8 else random.randint(2, 5)
+            yield user_id, game_id, first_day + datetime.timedelta(days=day), random.randint(1, 6), random.random() < 0.8
+
+
+def time_queries(queries):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(query())
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, results
+
+
+def bench_streaks(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'games.db')
+        with contextlib.redirect_stdout(None):
+            shard.create_sharding_games(database)
+        connection = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
+        users = [uuid.uuid4() for _ in range(args.users)]
+        connection.executemany('INSERT INTO games VALUES (?,?,?,?,?)', make_streak_games(users, args.games))
+        connection.execute(STREAKS_VIEW)
+        connection.commit()
+        games = connection.execute('SELECT COUNT(*) FROM games').fetchone()[0]
+
+        start = time.perf_counter()
+        userstats.rebuild(connection)
+        connection.commit()
+        build = time.perf_counter() - start
+
+        # The view is evaluated over the whole shard for every lookup, so it
+        # gets a smaller sample
+        sample = random.choices(users, k=args.lookups)
+        view_user, view_results = time_queries([
+            lambda user_id=user_id: (
+                (connection.execute("SELECT streak FROM streaks WHERE user_id = ? ORDER BY ending DESC",
+                                    [user_id]).fetchone() or [0])[0],
+                (connection.execute("SELECT streak FROM streaks WHERE user_id = ? ORDER BY streak DESC LIMIT 1",
+                                    [user_id]).fetchone() or [0])[0],
+            )
+            for user_id in sample[:args.view_lookups]
+        ])
+        index_user, index_results = time_queries([
+            lambda user_id=user_id: (
+                streakindex.current_streak(connection, user_id),
+                streakindex.max_streak(connection, user_id),
+            )
+            for user_id in sample
+        ])
+        view_top, view_rows = time_queries([
+            lambda: [row[0] for row in connection.execute(
+                "SELECT streak FROM streaks ORDER BY streak DESC LIMIT ?", [args.top])]
+        ] * args.top_runs)
+        index_top, index_rows = time_queries([
+            lambda: [row[1] for row in streakindex.top_streaks(connection, args.top)]
+        ] * args.top_runs)
+        connection.close()
+
+    if view_results != index_results[:args.view_lookups] or view_rows != index_rows:
+        print("warning: the view and the index disagree")
+    print(f"{games} games, {args.users} users; streak index built in {build:.2f}s\n")
+    print(f"{'query':<24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, latencies in [('user streaks (view)', view_user), ('user streaks (index)', index_user),
+                            (f'top {args.top} (view)', view_top), (f'top {args.top} (index)', index_top)]:
+        stats = summarize(latencies)
+        print(f"{name:<24}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subcommands = parser.add_subparsers(dest='command', required=True)
+
+    modes = subcommands.add_parser(
+        'modes',
+        help="compare /req/guess latency with HTTP hops and with co-located services",
+    )
+    modes.add_argument('--http-url', default='http://localhost:5400',
+                       help="req.py started with COLOCATED=false")
+    modes.add_argument('--colocated-url', default='http://localhost:5401',
+                       help="req.py started with COLOCATED=true")
+    modes.add_argument('--sessions', type=int, default=200)
+    modes.add_argument('--words', default='./share/words.sql')
+    modes.add_argument('--users', default='./var/users.db')
+    modes.set_defaults(run=bench_modes)
+
+    shard_load = subcommands.add_parser('shard-load', help="rows/sec of shard.py against the row-by-row loader")
+    shard_load.add_argument('--users', type=int, default=10000)
+    shard_load.add_argument('--games-per-user', type=int, default=100)
+    shard_load.add_argument('--shards', type=int, default=3)
+    shard_load.add_argument('--chunk-size', type=int, default=shard.CHUNK_SIZE)
+    shard_load.add_argument('--workers', type=int)
+    shard_load.set_defaults(run=bench_shard_load)
+
+    codec = subcommands.add_parser('codec', help="Redis memory of games in progress as JSON, hashes and packed")
+    codec.add_argument('--games', type=int, default=100000)
+    codec.add_argument('--redis-url', default='redis://localhost:6379/15',
+                       help="games are written under bench:codec: and deleted afterwards")
+    codec.add_argument('--words', default='./share/words.sql')
+    codec.set_defaults(run=bench_codec)
+
+    ingest = subcommands.add_parser('ingest', help="games/sec posted one at a time against /games/bulk")
+    ingest.add_argument('--url', default='http://localhost:5200', help="a statistics service")
+    ingest.add_argument('--games', type=int, default=2000)
+    ingest.add_argument('--batch-size', type=int, default=1000)
+    ingest.add_argument('--users', default='./var/users.db')
+    ingest.set_defaults(run=bench_ingest)
+
+    streaks = subcommands.add_parser('streaks', help="streak lookups through the streaks view against the streak index")
+    streaks.add_argument('--games', type=int, default=1000000)
+    streaks.add_argument('--users', type=int, default=10000)
+    streaks.add_argument('--lookups', type=int, default=1000)
+    streaks.add_argument('--view-lookups', type=int, default=20)
+    streaks.add_argument('--top', type=int, default=10)
+    streaks.add_argument('--top-runs', type=int, default=5)
+    streaks.set_defaults(run=bench_streaks)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+#!/bin/sh
+
+http --verbose POST localhost:5200/games/bulk Content-Type:application/x-ndjson < "$1"
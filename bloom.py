@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Bloom filters of the games in each shard, kept in Redis as bitsets.
+# start_game asks the filter of the user's shard whether the user may
+# already have played a game, and only reads the shard when it says yes.
+# Every game is added to the filter once it is committed to its shard, so a
+# "no" is always right and a "yes" is wrong at about the configured error
+# rate while a shard holds no more than the configured capacity.
+#
+# The size and number of hashes are part of the key, so processes configured
+# differently never read each other's filters. A filter that does not exist
+# yet answers neither, and the shard is read instead. Filters are built by the
+# state service at startup or whenever it finds them missing, or rebuilt with
+# this program. ./shard.py deletes them when it reloads the shards, and
+# ./shardrouter.py adds the games of each user it moves to the filter of their
+# new shard before moving them. To rebuild every filter from the shards:
+#
+#     ./bloom.py [--capacity 1000000] [--error-rate 0.01]
+import argparse
+import hashlib
+import math
+import os
+import threading
+import time
+import uuid
+
+import redis
+
+import shardrouter
+
+CAPACITY = 1000000
+ERROR_RATE = 0.01
+
+# Games read from a shard and added per round trip while building
+BUILD_BATCH_SIZE = 5000
+
+# KEYS: filters; ARGV: bit positions. Filters that do not exist are left
+# alone so a filter being built is never mistaken for a complete one.
+ADD_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        for i = 1, #ARGV do
+            redis.call('SETBIT', key, ARGV[i], 1)
+        end
+    end
+end
+return 1
+"""
+
+# KEYS: filter; ARGV: bit positions. 1 if every bit is set, 0 if not, -1 if
+# there is no filter
+CHECK_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+for i = 1, #ARGV do
+    if redis.call('GETBIT', KEYS[1], ARGV[i]) == 0 then
+        return 0
+    end
+end
+return 1
+"""
+
+
+def size(capacity, error_rate):
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class BloomFilter:
+    def __init__(self, client_redis, shard, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self.client_redis = client_redis
+        self.shard = shard
+        self.bits, self.hashes = size(capacity, error_rate)
+        self.key = f"games:bloom:{shard}:{self.bits}:{self.hashes}"
+        self.staging = f"{self.key}:staging"
+        self._add = client_redis.register_script(ADD_SCRIPT)
+        self._check = client_redis.register_script(CHECK_SCRIPT)
+
+    # Double hashing of one (user_id, game_id) pair
+    def positions(self, user_id, game_id):
+        if not isinstance(user_id, uuid.UUID):
+            user_id = uuid.UUID(str(user_id))
+        digest = hashlib.blake2b(user_id.bytes + int(game_id).to_bytes(8, 'big'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    # Add (user_id, game_id) pairs to the filter, and to the one being built
+    # if there is one
+    def add(self, pairs):
+        positions = [position for user_id, game_id in pairs for position in self.positions(user_id, game_id)]
+        if positions:
+            self._add(keys=[self.key, self.staging], args=positions)
+
+    # True if the user may have played the game, False if they have not, or
+    # None if there is no filter to ask
+    def might_contain(self, user_id, game_id):
+        result = self._check(keys=[self.key], args=self.positions(user_id, game_id))
+        return None if result == -1 else bool(result)
+
+    def exists(self):
+        return bool(self.client_redis.exists(self.key))
+
+    # Build the filter from the shard under a staging key and rename it over
+    # the live one. Games committed while it runs are added to both.
+    def build(self, database):
+        pipe = self.client_redis.pipeline(transaction=True)
+        pipe.delete(self.staging)
+        pipe.setbit(self.staging, self.bits - 1, 0)
+        pipe.execute()
+
+        count = 0
+        connection = shardrouter.connect(database)
+        try:
+            cursor = connection.execute("SELECT user_id, game_id FROM games")
+            while True:
+                rows = cursor.fetchmany(BUILD_BATCH_SIZE)
+                if not rows:
+                    break
+                positions = [position for user_id, game_id in rows for position in self.positions(user_id, game_id)]
+                self._add(keys=[self.staging], args=positions)
+                count += len(rows)
+        finally:
+            connection.close()
+        self.client_redis.rename(self.staging, self.key)
+        return count
+
+    # Build the filter unless it exists or another process is building it
+    def ensure(self, database, lock_timeout=600):
+        if self.exists():
+            return False
+        lock = f"{self.key}:building"
+        if not self.client_redis.set(lock, 1, nx=True, ex=lock_timeout):
+            return False
+        try:
+            self.build(database)
+        finally:
+            self.client_redis.delete(lock)
+        return True
+
+    # Share of bits set, and the error rate that gives for new lookups
+    def fill(self):
+        ones = self.client_redis.bitcount(self.key)
+        ratio = ones / self.bits
+        return ratio, ratio ** self.hashes
+
+
+# Delete every filter, for when the shards are reloaded. The state service
+# builds them again when it next finds them missing.
+def drop(client_redis):
+    keys = list(client_redis.scan_iter(match="games:bloom:*"))
+    if keys:
+        client_redis.delete(*keys)
+    return len(keys)
+
+
+def filters(client_redis, router, capacity=CAPACITY, error_rate=ERROR_RATE):
+    return {shard: BloomFilter(client_redis, shard, capacity, error_rate) for shard in router.shards}
+
+
+# Filters for the command line tools, configured with the same variables as
+# the services' settings
+def from_env(client_redis, router):
+    return filters(
+        client_redis, router,
+        int(os.environ.get('BLOOM_CAPACITY', CAPACITY)),
+        float(os.environ.get('BLOOM_ERROR_RATE', ERROR_RATE)),
+    )
+
+
+# Build missing filters on a background thread, so the service starts at
+# once and reads the shards until they are ready
+def ensure_all_in_background(bloom_filters, router, logger):
+    def run():
+        for shard, bloom_filter in bloom_filters.items():
+            try:
+                if bloom_filter.ensure(router.databases[shard - 1]):
+                    logger.info("Built the bloom filter for shard %d", shard)
+            except (redis.RedisError, OSError):
+                logger.exception("Could not build the bloom filter for shard %d", shard)
+
+    thread = threading.Thread(target=run, name="bloom-build", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the bloom filters of the games in each shard")
+    parser.add_argument('--capacity', type=int, default=int(os.environ.get('BLOOM_CAPACITY', CAPACITY)),
+                        help="games per shard the error rate holds for")
+    parser.add_argument('--error-rate', type=float, default=float(os.environ.get('BLOOM_ERROR_RATE', ERROR_RATE)))
+    args = parser.parse_args()
+
+    client_redis = redis.Redis()
+    router = shardrouter.from_env()
+    for shard, bloom_filter in filters(client_redis, router, args.capacity, args.error_rate).items():
+        start = time.perf_counter()
+        count = bloom_filter.build(router.databases[shard - 1])
+        ratio, error_rate = bloom_filter.fill()
+        print(f"Shard {shard}: {count} games in {bloom_filter.bits} bits with {bloom_filter.hashes} hashes "
+              f"({ratio:.1%} set, {error_rate:.3%} false positives) in {time.perf_counter() - start:.2f}s")
+
+if __name__ == '__main__':
+    main()
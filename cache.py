@@ -0,0 +1,197 @@
+# Read-through caches in front of SQLite.
+# LRUCache is a bounded in-process cache with a TTL per entry. ResponseCache
+# keeps rendered responses in Redis with an LRUCache in front of it: lookups
+# try this process first, then Redis, and only then the database. Invalidating
+# a key deletes it from Redis and publishes it, so every process drops its
+# own copy as well.
+import collections
+import hashlib
+import threading
+import time
+
+import redis
+
+
+class LRUCache:
+    def __init__(self, maxsize=10000, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Returns (True, value) for a live entry and (False, None) otherwise, so
+    # None can be cached
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# A response body is stored only if its key was not invalidated while the
+# body was being computed, so a slow reader cannot cache stale data
+SET_IF_CURRENT = """
+if redis.call('GET', KEYS[2]) ~= (ARGV[3] ~= '' and ARGV[3] or false) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+def etag(body):
+    return '"' + hashlib.blake2b(body.encode('utf-8'), digest_size=12).hexdigest() + '"'
+
+
+class ResponseCache:
+    def __init__(self, client_redis, prefix, maxsize=10000, ttl=3600, local_ttl=30.0):
+        self.client_redis = client_redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.channel = f"{prefix}:invalidate"
+        self.local = LRUCache(maxsize, local_ttl)
+        # When each key was last invalidated, so callers reading from a
+        # replica can tell whether it has the write yet
+        self.invalidated = LRUCache(maxsize, ttl)
+        self._set_if_current = client_redis.register_script(SET_IF_CURRENT)
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._thread = None
+        self.counters = collections.Counter()
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def _generation_key(self, key):
+        return f"{self.prefix}:generation:{key}"
+
+    def count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    # The cached (body, etag) for key, or compute() -> body on a miss. Redis
+    # errors fall back to compute() so the cache never takes the service down.
+    def get(self, key, compute):
+        found, value = self.local.lookup(key)
+        if found:
+            self.count("local_hits")
+            return value
+
+        generation = self._generation
+        try:
+            body, redis_generation = self.client_redis.mget(self._key(key), self._generation_key(key))
+        except redis.RedisError:
+            self.count("errors")
+            return self._compute(compute)
+        if body is not None:
+            self.count("redis_hits")
+            value = (body.decode('utf-8'), etag(body.decode('utf-8')))
+            self._fill_local(key, value, generation)
+            return value
+
+        self.count("misses")
+        value = self._compute(compute)
+        try:
+            stored = self._set_if_current(
+                keys=[self._key(key), self._generation_key(key)],
+                args=[value[0], self.ttl, redis_generation or ''],
+            )
+        except redis.RedisError:
+            self.count("errors")
+            return value
+        if stored:
+            self._fill_local(key, value, generation)
+        return value
+
+    def _compute(self, compute):
+        body = compute()
+        return body, etag(body)
+
+    def _fill_local(self, key, value, generation):
+        with self._lock:
+            if generation == self._generation:
+                self.local.set(key, value)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+        for key in keys:
+            self.local.delete(key)
+            self.invalidated.set(key, time.time())
+        pipe = self.client_redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.incr(self._generation_key(key))
+            pipe.expire(self._generation_key(key), self.ttl)
+            pipe.delete(self._key(key))
+            pipe.publish(self.channel, key)
+        pipe.execute()
+        with self._lock:
+            self.counters["invalidations"] += len(keys)
+
+    def _on_invalidate(self, message):
+        key = message['data']
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        with self._lock:
+            self._generation += 1
+        self.local.delete(key)
+        self.invalidated.set(key, time.time())
+
+    # The time key was last invalidated by any process, if within the TTL
+    def invalidated_at(self, key):
+        return self.invalidated.lookup(key)[1]
+
+    # Listen for invalidations from other processes
+    def start(self):
+        self._pubsub = self.client_redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self.channel: self._on_invalidate})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        hits = counters.get("local_hits", 0) + counters.get("redis_hits", 0)
+        lookups = hits + counters.get("misses", 0)
+        return {
+            "local_hits": counters.get("local_hits", 0),
+            "redis_hits": counters.get("redis_hits", 0),
+            "misses": counters.get("misses", 0),
+            "invalidations": counters.get("invalidations", 0),
+            "not_modified": counters.get("not_modified", 0),
+            "errors": counters.get("errors", 0),
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0,
+            "local_entries": len(self.local),
+        }
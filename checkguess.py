@@ -1,20 +1,36 @@
 import contextlib
 import logging.config
-from operator import countOf
 import sqlite3
+from typing import List
 
 
+import httpx
+import redis
 from fastapi import FastAPI, Depends, HTTPException, status
-from pydantic import BaseSettings
+from pydantic import BaseModel, BaseSettings
+
+import feedback
+import instrument
+import schedule
+import scoring
 
 
 class Settings(BaseSettings):
     answer_database: str
     logging_config: str
 
+    # Built by ./feedback.py; hints are unavailable without it
+    feedback_matrix: str = "./var/feedback.npy"
+    # Game state is read from trackgamestate through Traefik
+    api_url: str = "http://localhost:9999"
+
     class Config:
         env_file = ".env"
 
+class Guess(BaseModel):
+    game_id: int
+    guess: str
+
 def get_db():
     with contextlib.closing(sqlite3.connect(settings.answer_database)) as db:
         db.row_factory = sqlite3.Row
@@ -26,44 +42,173 @@ def get_logger():
 
 
 settings = Settings()
+client_redis = instrument.instrument_redis(redis.Redis())
 app = FastAPI(root_path="/guess")
+instrument.instrument(app)
+
+instrument.configure_logging(settings.logging_config)
+
+# All answers are held in memory by the scoring engine. The scheduled
+# answers pushed by req.py and changes made through /add_answer and
+# /change_answer on any worker arrive on schedule.CHANNEL.
+answers = scoring.AnswerBook()
+answer_updates = None
+answer_listener = None
+
+@app.on_event("startup")
+def load_answers():
+    global answers
+    answers = scoring.AnswerBook.load(settings.answer_database)
+    get_logger().info("Loaded %d answers into the answer cache", len(answers))
+
+def on_answer(message):
+    try:
+        game_id, answer = schedule.parse_answer(message)
+        answers.set(game_id, answer)
+    except (ValueError, KeyError):
+        get_logger().warning("Ignoring answer update %r", message['data'])
+
+@app.on_event("startup")
+def start_answer_updates():
+    global answer_updates, answer_listener
+    answer_updates = client_redis.pubsub(ignore_subscribe_messages=True)
+    answer_updates.subscribe(**{schedule.CHANNEL: on_answer})
+    answer_listener = answer_updates.run_in_thread(sleep_time=1.0, daemon=True)
+
+@app.on_event("shutdown")
+def stop_answer_updates():
+    if answer_listener is not None:
+        answer_listener.stop()
+    if answer_updates is not None:
+        answer_updates.close()
+
+def publish_answer(game_id, answer):
+    try:
+        schedule.publish_answers(client_redis, [(game_id, answer)])
+    except redis.RedisError:
+        get_logger().warning("Could not publish the answer of game %d to the other workers", game_id)
+
+# The feedback table is memory-mapped, so workers share one copy
+feedback_table = None
+client = None
+
+@app.on_event("startup")
+def load_feedback():
+    global feedback_table, client
+    client = httpx.Client(base_url=settings.api_url, timeout=5.0)
+    try:
+        feedback_table = feedback.FeedbackTable.load(settings.feedback_matrix)
+    except FileNotFoundError:
+        get_logger().warning("No feedback table at %s, hints are disabled", settings.feedback_matrix)
+        return
+    missing = {answers.get(game_id) for game_id in range(len(answers.known))} - set(feedback_table.answers) - {None}
+    if missing:
+        get_logger().warning("%d answers are missing from the feedback table; rerun ./feedback.py", len(missing))
+
+@app.on_event("shutdown")
+def close_client():
+    if client is not None:
+        client.close()
+
+def check_letters(guess):
+    try:
+        scoring.encode(guess)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"{guess} not five lowercase letters."
+        )
+
+def format_score(guess, score):
+    response_list = []
+    for letter, result in zip(guess, score):
+        if result == scoring.CORRECT:
+            response_list.append({"correct" : f"{letter}"})
+        elif result == scoring.PRESENT:
+            response_list.append({"present" : f"{letter}"})
+
+    if not response_list:
+      response_list.append({"status": "incorrect"})
 
-logging.config.fileConfig(settings.logging_config)
+    return response_list
 
 @app.get("/check")
 def check_guess(
     game_id: int,
-    guess: str,
-    db: sqlite3.Connection = Depends(get_db)
+    guess: str
 ):
-    answer = ""
-    for row in db.execute("SELECT * FROM answers WHERE game_id = ? LIMIT 1", [game_id]):
-        answer = row['answer']
+    check_letters(guess)
+    score = answers.score(game_id, guess)
 
-    if not answer:
+    if score is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
         )
 
-    response_list = []
-
+    return {"response": format_score(guess, score)}
 
-    for i in range(len(guess)):
-        if guess[i] == answer[i]:
-            response_list.append({"correct" : f"{guess[i]}"})
-        elif guess[i] in answer:
-            response_list.append({"present" : f"{guess[i]}"})
+# Score many guesses in a single call
+@app.post("/check_batch")
+def check_guesses(
+    guesses: List[Guess]
+):
+    for g in guesses:
+        check_letters(g.guess)
+    scores = answers.score_batch([g.game_id for g in guesses], [g.guess for g in guesses])
+
+    results = []
+    for g, score in zip(guesses, scores):
+        if score is None:
+            results.append({"game_id": g.game_id, "detail": "Game not found"})
+        else:
+            results.append({"game_id": g.game_id, "response": format_score(g.guess, score)})
+    return {"results": results}
+
+# Answers still possible after the guesses made so far in a game, and the
+# guess expected to narrow them down the most
+@app.get("/hint")
+def hint(
+    user_id: str,
+    game_id: int,
+    limit: int = 10
+):
+    if feedback_table is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Hints are not available"
+        )
+    if game_id not in answers:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
+        )
 
-    if not response_list:
-      response_list.append({"status": "incorrect"})
+    r = client.get('/games/restore', params={'user_id': user_id, 'game_id': game_id})
+    if r.status_code == status.HTTP_404_NOT_FOUND:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
+        )
+    if r.is_error:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY, detail="Game state unavailable"
+        )
 
-    return {"response": response_list}
+    state = r.json()
+    guesses = [state[f'guess{n}'] for n in range(1, 7) if state[f'guess{n}']]
+    candidates = feedback_table.candidates([(guess, answers.score(game_id, guess)) for guess in guesses])
+    best_guess, bits = feedback_table.best_guess(candidates)
+    return {
+        "game_id": game_id,
+        "guesses": guesses,
+        "remaining": len(candidates),
+        "candidates": [feedback_table.answers[i] for i in candidates[:limit]],
+        "best_guess": best_guess,
+        "bits": round(bits, 2),
+    }
 
 @app.post("/add_answer", status_code=status.HTTP_201_CREATED)
 def add_asnwer(
     answer: str,
     db: sqlite3.Connection = Depends(get_db)
 ):
+    check_letters(answer)
     try:
         cur =  db.execute("INSERT INTO answers(answer) VALUES(?)", [answer])
         db.commit()
@@ -73,6 +218,8 @@ def add_asnwer(
             detail={"type": type(e).__name__, "msg": str(e)},
         )
     new_answer_id = cur.lastrowid
+    answers.set(new_answer_id, answer)
+    publish_answer(new_answer_id, answer)
     return {"id": f"{new_answer_id}", "answer": f"{answer}"}
 
 @app.patch("/change_answer")
@@ -81,10 +228,11 @@ def change_answer(
     new_answer: str,
     db: sqlite3.Connection = Depends(get_db)
 ):
+    check_letters(new_answer)
     cur =  db.execute("SELECT * FROM answers WHERE game_id = ? LIMIT 1", [game_id])
-    answers = cur.fetchall()
+    rows = cur.fetchall()
 
-    if not answers:
+    if not rows:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
         )
@@ -96,4 +244,6 @@ def change_answer(
             status_code=status.HTTP_409_CONFLICT,
             detail={"type": type(e).__name__, "msg": str(e)},
         )
+    answers.set(game_id, new_answer)
+    publish_answer(game_id, new_answer)
     return {"game_id": f"{game_id}", "answer": f"{new_answer}"}
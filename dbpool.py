@@ -0,0 +1,185 @@
+# Shared SQLite connection pools for the services.
+# One pool is kept per database file; connections are opened once in WAL mode
+# with tuned pragmas and reused across requests instead of being opened and
+# closed by every dependency. Statements run on pooled connections are timed
+# for the services' /metrics.
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import instrument
+
+sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
+sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+    "busy_timeout": 5000,
+}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Times the statements executed through the connection; rows fetched
+# afterwards from a cursor are not included
+class TimedConnection(sqlite3.Connection):
+    label = None
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            instrument.sqlite_seconds.observe(time.perf_counter() - start, self.label)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            instrument.sqlite_seconds.observe(time.perf_counter() - start, self.label)
+
+
+class ConnectionPool:
+    def __init__(self, database, size=5, timeout=5.0, pragmas=PRAGMAS):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.label = os.path.basename(database)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        db = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            factory=TimedConnection,
+        )
+        db.label = self.label
+        db.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            db.execute(f"PRAGMA {name} = {value}")
+        return db
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            grow = self._created < self.size
+            if grow:
+                self._created += 1
+        if grow:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f"No connection to {self.database} available after {self.timeout}s")
+
+    @contextlib.contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        db = self._acquire()
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        instrument.sqlite_checkouts.inc(self.label)
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                db.rollback()
+            with self._lock:
+                self._in_use -= 1
+            self._idle.put(db)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "database": self.database,
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "wait_total_ms": round(self._wait_total * 1000, 3),
+                "wait_avg_ms": round(self._wait_total * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+
+
+# Pools are shared per database file within a process
+_pools = {}
+_pools_lock = threading.Lock()
+_config = {"size": 5, "timeout": 5.0}
+
+
+def configure(size=None, timeout=None):
+    if size is not None:
+        _config["size"] = size
+    if timeout is not None:
+        _config["timeout"] = timeout
+
+
+def get_pool(database):
+    with _pools_lock:
+        pool = _pools.get(database)
+        if pool is None:
+            pool = _pools[database] = ConnectionPool(database, **_config)
+        return pool
+
+
+def connection(database):
+    return get_pool(database).connection()
+
+
+def stats():
+    with _pools_lock:
+        return [pool.stats() for pool in _pools.values()]
+
+
+def close_all():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# Precomputed feedback for every (guess, answer) pair, for solver hints.
+# The feedback of a guess against an answer is packed into one byte, the five
+# ABSENT/PRESENT/CORRECT marks as a base-3 number, and the full table is saved
+# as a uint8 .npy with the guess and answer lists beside it. The services load
+# it memory-mapped, so every worker shares the same pages.
+#
+# Rebuild it after adding or changing answers:
+#
+#     ./feedback.py [--words ./var/words.db] [--answers ./var/answers.db] [--output ./var/feedback.npy]
+import argparse
+import contextlib
+import json
+import sqlite3
+import time
+
+import numpy as np
+
+import scoring
+
+PATTERNS = 3 ** scoring.WORD_LENGTH
+
+# Guesses scored or counted one block at a time, to bound memory
+BLOCK_SIZE = 256
+
+
+def pattern(score):
+    score = np.asarray(score, dtype=np.uint8).reshape(-1, scoring.WORD_LENGTH)
+    return (score * (3 ** np.arange(scoring.WORD_LENGTH))).sum(axis=1).astype(np.uint8)
+
+
+def words_path(path):
+    return path[:-len('.npy')] + '.words.json' if path.endswith('.npy') else path + '.words.json'
+
+
+def build(guesses, answers):
+    guess_codes = np.stack([scoring.encode(word) for word in guesses])
+    answer_codes = np.stack([scoring.encode(word) for word in answers])
+    matrix = np.empty((len(guesses), len(answers)), dtype=np.uint8)
+    for start in range(0, len(guesses), BLOCK_SIZE):
+        block = guess_codes[start:start + BLOCK_SIZE]
+        scores = scoring.score_codes(np.tile(answer_codes, (len(block), 1)), np.repeat(block, len(answers), axis=0))
+        matrix[start:start + len(block)] = pattern(scores).reshape(len(block), len(answers))
+    return matrix
+
+
+def save(path, matrix, guesses, answers, opening):
+    np.save(path, matrix)
+    with open(words_path(path), 'w') as f:
+        json.dump({"guesses": guesses, "answers": answers, "opening": opening}, f)
+
+
+# n * log2(n) for every group size up to the number of answers, so entropy is
+# summed from integer counts without a log per (guess, pattern)
+def xlogx_table(size):
+    n = np.arange(size + 1, dtype=np.float64)
+    n[0] = 1.0
+    return np.arange(size + 1) * np.log2(n)
+
+
+# Bits of information each guess gives about which candidate is the answer:
+# log2(k) - sum(n * log2(n)) / k over the groups of n candidates per pattern.
+# Guesses are counted BLOCK_SIZE at a time so the counts stay in cache.
+def entropies(matrix, candidates, xlogx=None):
+    if xlogx is None:
+        xlogx = xlogx_table(len(candidates))
+    spread = np.empty(matrix.shape[0])
+    offsets = np.arange(BLOCK_SIZE, dtype=np.int32)[:, None] * PATTERNS
+    for start in range(0, matrix.shape[0], BLOCK_SIZE):
+        block = np.asarray(matrix[start:start + BLOCK_SIZE, candidates], dtype=np.int32)
+        block += offsets[:len(block)]
+        counts = np.bincount(block.ravel(), minlength=len(block) * PATTERNS)
+        spread[start:start + len(block)] = xlogx[counts].reshape(len(block), PATTERNS).sum(axis=1)
+    return np.log2(len(candidates)) - spread / len(candidates)
+
+
+class FeedbackTable:
+    def __init__(self, matrix, guesses, answers, opening=None):
+        self.matrix = matrix
+        self.guesses = guesses
+        self.answers = answers
+        self.guess_index = {word: i for i, word in enumerate(guesses)}
+        self.all_candidates = np.arange(len(answers))
+        # Row of each answer among the guesses, or -1
+        self.answer_rows = np.array([self.guess_index.get(word, -1) for word in answers])
+        self.opening = tuple(opening) if opening else None
+        self.xlogx = xlogx_table(len(answers))
+
+    @classmethod
+    def load(cls, path):
+        with open(words_path(path)) as f:
+            words = json.load(f)
+        matrix = np.load(path, mmap_mode='r')
+        # Touch every page now rather than in the first hint
+        matrix.sum(dtype=np.uint64)
+        return cls(matrix, words["guesses"], words["answers"], words.get("opening"))
+
+    # Indexes of the answers consistent with every (guess, score) seen so far
+    def candidates(self, history):
+        candidates = self.all_candidates
+        for guess, score in history:
+            row = self.guess_index.get(guess)
+            if row is None:
+                continue
+            candidates = candidates[self.matrix[row, candidates] == pattern(score)[0]]
+        return candidates
+
+    # The guess splitting the candidates into the most even groups. Guesses
+    # that could themselves be the answer win ties.
+    def best_guess(self, candidates):
+        if len(candidates) == 0:
+            return None, 0.0
+        if len(candidates) == 1:
+            return self.answers[candidates[0]], 0.0
+        if len(candidates) == len(self.answers) and self.opening is not None:
+            return self.opening
+
+        scores = entropies(self.matrix, candidates, self.xlogx)
+        bonus = np.zeros(len(self.guesses))
+        rows = self.answer_rows[candidates]
+        bonus[rows[rows >= 0]] = 1 / len(candidates)
+        best = int(np.argmax(scores + bonus))
+        return self.guesses[best], float(scores[best])
+
+
+def load_words(database, sql):
+    with contextlib.closing(sqlite3.connect(database)) as db:
+        return [row[0] for row in db.execute(sql)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute guess feedback for solver hints")
+    parser.add_argument('--words', default='./var/words.db')
+    parser.add_argument('--answers', default='./var/answers.db')
+    parser.add_argument('--output', default='./var/feedback.npy')
+    args = parser.parse_args()
+
+    answers = sorted(set(load_words(args.answers, "SELECT answer FROM answers")))
+    guesses = sorted(set(load_words(args.words, "SELECT word FROM words")) | set(answers))
+
+    start = time.perf_counter()
+    matrix = build(guesses, answers)
+    table = FeedbackTable(matrix, guesses, answers)
+    # The opening guess takes the longest to find, so it is saved with the table
+    opening = table.best_guess(table.all_candidates)
+    save(args.output, matrix, guesses, answers, opening)
+    print(f"{len(guesses)} guesses x {len(answers)} answers ({matrix.nbytes / 2 ** 20:.1f} MiB) "
+          f"saved to {args.output} in {time.perf_counter() - start:.1f}s")
+    print(f"Best opening guess: {opening[0]} ({opening[1]:.2f} bits)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Packed encoding of a game in progress, as stored in Redis.
+#
+#     offset  size  field
+#          0     1  format version
+#          1    16  user_id (UUID bytes)
+#         17     4  game_id (unsigned, big-endian)
+#         21     1  remaining guesses
+#         22    30  guesses 1-6, five ASCII letters each, zeros when unused
+#
+# Every game is 52 bytes, and a guess is recorded by overwriting one slot and
+# the remaining count in place (see trackgamestate.py). Games saved as JSON
+# strings or hashes by older versions are converted with from_legacy.
+import json
+import struct
+import uuid
+
+VERSION = 1
+GUESSES = 6
+SLOT_SIZE = 5
+
+HEADER = struct.Struct('>B16sIB')
+REMAIN_OFFSET = HEADER.size - 1
+SLOTS_OFFSET = HEADER.size
+SIZE = HEADER.size + GUESSES * SLOT_SIZE
+
+EMPTY_SLOT = bytes(SLOT_SIZE)
+
+
+class CodecError(ValueError):
+    pass
+
+
+# game_id is stored in four bytes
+MAX_GAME_ID = 2 ** 32 - 1
+
+
+def encode_slot(guess):
+    if not guess:
+        return EMPTY_SLOT
+    if not isinstance(guess, str) or len(guess) != SLOT_SIZE or not guess.isascii() or not guess.isalpha():
+        raise CodecError(f"guess {guess!r} is not {SLOT_SIZE} letters")
+    return guess.encode('ascii')
+
+
+def encode(game):
+    slots = b''.join(encode_slot(game.get(f'guess{n}')) for n in range(1, GUESSES + 1))
+    game_id = int(game['game_id'])
+    if not 0 <= game_id <= MAX_GAME_ID:
+        raise CodecError(f"game_id {game_id} is out of range")
+    remain_guess = int(game['remain_guess'])
+    if not 0 <= remain_guess <= GUESSES:
+        raise CodecError(f"remain_guess {remain_guess} is out of range")
+    header = HEADER.pack(VERSION, uuid.UUID(str(game['user_id'])).bytes, game_id, remain_guess)
+    return header + slots
+
+
+def decode(data):
+    if len(data) != SIZE or data[0] != VERSION:
+        raise CodecError(f"not a version {VERSION} game")
+    _, user_id, game_id, remain_guess = HEADER.unpack_from(data)
+    game = {"user_id": str(uuid.UUID(bytes=user_id)), "game_id": game_id}
+    for n in range(GUESSES):
+        slot = data[SLOTS_OFFSET + n * SLOT_SIZE:SLOTS_OFFSET + (n + 1) * SLOT_SIZE]
+        game[f'guess{n + 1}'] = None if slot == EMPTY_SLOT else slot.decode('ascii')
+    game["remain_guess"] = remain_guess
+    return game
+
+
+def is_packed(data):
+    return len(data) == SIZE and data[0] == VERSION
+
+
+# A game from a JSON string or from the fields of a hash, as saved by older
+# versions of trackgamestate.py. Values that cannot be converted raise
+# CodecError.
+def from_legacy(value):
+    try:
+        if isinstance(value, dict):
+            game = {k.decode('utf-8'): v.decode('utf-8') for k, v in value.items()}
+        else:
+            game = json.loads(value)
+        game = {
+            "user_id": str(uuid.UUID(str(game["user_id"]))),
+            "game_id": int(game["game_id"]),
+            **{f'guess{n}': game.get(f'guess{n}') for n in range(1, GUESSES + 1)},
+            "remain_guess": int(game["remain_guess"]),
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise CodecError(f"not a legacy game: {e!r}") from e
+    # Check every field now rather than when the game is packed
+    encode(game)
+    return game
@@ -0,0 +1,261 @@
+# Metrics and logging shared by the services.
+# instrument(app) times every request by route and adds a /metrics endpoint in
+# the Prometheus text format. dbpool times the SQLite statements run on its
+# connections and counts checkouts per database file, which shows how requests
+# spread over the shards, and instrument_redis times every Redis round trip
+# made through a client. Each process keeps its own metrics, so every
+# instance is scraped separately.
+#
+# configure_logging applies etc/logging.ini and then moves its handlers
+# behind a queue, so writing the log file happens on a background thread
+# instead of in the request.
+import atexit
+import bisect
+import http.server
+import logging
+import logging.config
+import logging.handlers
+import queue
+import threading
+import time
+
+from starlette.responses import PlainTextResponse
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_registry = []
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    # Counts per bucket are kept separately and summed when rendered
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[i] += 1
+            self._values[labels] = (counts, total + value)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = format_labels(self.labels + ('le',), labels + (str(bound),))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}"
+
+
+# Sampled when rendered: collect returns a dict of label tuples to values
+class Gauge:
+    def __init__(self, name, description, labels=(), collect=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.collect = collect
+        _registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} gauge"
+        try:
+            values = self.collect()
+        except Exception:
+            logging.getLogger(__name__).exception("Could not collect %s", self.name)
+            return
+        for labels, value in values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape(value)}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+request_seconds = Histogram("http_request_duration_seconds", "Request latency by route", ("method", "route"))
+requests_total = Counter("http_requests_total", "Requests by route and status", ("method", "route", "status"))
+sqlite_seconds = Histogram("sqlite_query_duration_seconds", "Time spent executing SQLite statements", ("database",))
+sqlite_checkouts = Counter("sqlite_checkouts_total", "Pooled connections checked out per database", ("database",))
+redis_seconds = Histogram("redis_roundtrip_duration_seconds", "Redis round trips by command", ("command",))
+
+
+# Times requests by the path of the route that handled them, so /users/{user_id}
+# is one series rather than one per user
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._routes = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = self.route(scope)
+            request_seconds.observe(time.perf_counter() - start, scope["method"], route)
+            requests_total.inc(scope["method"], route, status[0])
+
+    def route(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if endpoint not in self._routes:
+            app = scope.get("app")
+            for route in getattr(app, "routes", []):
+                if getattr(route, "endpoint", None) is endpoint:
+                    self._routes[endpoint] = route.path
+                    break
+            else:
+                self._routes[endpoint] = getattr(endpoint, "__name__", "unknown")
+        return self._routes[endpoint]
+
+
+def instrument(app):
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
+# /metrics for scripts that run without a web app, on a background thread
+def serve_metrics(port):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Time every command, script and pipeline sent through a Redis client. Each
+# pipeline is one round trip.
+def instrument_redis(client):
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def timed_command(*args, **options):
+        start = time.perf_counter()
+        try:
+            return execute_command(*args, **options)
+        finally:
+            redis_seconds.observe(time.perf_counter() - start, str(args[0]).upper())
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def timed_execute(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                redis_seconds.observe(time.perf_counter() - start, "PIPELINE")
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_command
+    client.pipeline = timed_pipeline
+    return client
+
+
+_listener = None
+
+
+def configure_logging(config_file):
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    logging.config.fileConfig(config_file)
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    records = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def stop_logging():
+    if _listener is not None:
+        _listener.stop()
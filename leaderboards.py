@@ -4,64 +4,355 @@
 # the win/loss shards and pull the top 10 entries from each view. Then connect to Redis and store
 # each entry in a sorted set.
 # Note: this means that you will be storing 30 entries from each view (10 from each shard).
+#
+# The statistics service now updates both sorted sets as each game is recorded, so they hold every
+# player and this program only reconciles them with the shards to repair any drift. The shards are
+# read concurrently from their user summaries, usernames are resolved in batches, and each sorted
+# set is replaced atomically in a single pipeline. Every player whose games are recorded is added to
+# the leaderboards:touched set, whatever date the games finished on. With --incremental only those
+# players are rescanned and merged into the sets, and the set is emptied:
+#
+#     ./leaderboards.py [--incremental] [--limit N] [--users ./var/users.db] [--replicas]
+#
+# With --replicas the shards are read from the copies kept by ./replicate.py,
+# for each shard whose copy is at most --max-staleness seconds old.
+#
+# Wins are also counted per day in wins:daily:<date>, one sorted set for each
+# of the last WINDOW_DAYS days. The weekly board is the union of the seven
+# daily sets ending on a date, built with ZUNIONSTORE and kept for
+# WEEKLY_TTL seconds, so neither board rescans the shards.
+import argparse
+import base64
+import datetime
+import json
+import os
 import sqlite3
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
 import redis
 
-def get_top_streaks_shard(shardnum):
-    sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
-    sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
-    game_connection = sqlite3.connect(f'./var/games{str(shardnum)}.db', detect_types=sqlite3.PARSE_DECLTYPES)
-    game_cur = game_connection.cursor()
+import replicate
+import shardrouter
 
-    user_connection = sqlite3.connect('./var/users.db', detect_types=sqlite3.PARSE_DECLTYPES)
-    user_cur = user_connection.cursor()
+sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
+sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
 
-    streaks = game_cur.execute("SELECT * FROM streaks ORDER BY streak DESC LIMIT 10").fetchall()
+LAST_RUN_KEY = "leaderboards:last_run"
 
-    players_and_streaks = []
+# Usernames of the players recorded since the last run, and those taken by a
+# run that has not finished yet
+TOUCHED_KEY = "leaderboards:touched"
+DRAINING_KEY = "leaderboards:touched:draining"
 
-    for user in streaks:
-        player = user_cur.execute("SELECT * FROM users WHERE user_id = ? LIMIT 1", [user[0]]).fetchall()
-        username = player[0][1]
-        num_streak = user[1]
-        players_and_streaks.append({"username" : username, "streaks" : num_streak})
-    
-    game_connection.close()
-    user_connection.close()
+# SQLite limits the number of parameters in one statement, and large sorted
+# sets are written in several ZADDs
+BATCH_SIZE = 500
+ZADD_BATCH_SIZE = 10000
+
+BOARDS = ("wins", "streaks")
+WINDOWS = ("all", "daily", "weekly")
+
+# Daily win counts are kept for a week, plus a day for time zones
+WINDOW_DAYS = 7
+DAILY_RETENTION_DAYS = WINDOW_DAYS + 1
+WEEKLY_TTL = 60
+
+def daily_key(date):
+    return f"wins:daily:{date.isoformat()}"
+
+def weekly_key(date):
+    return f"wins:weekly:{date.isoformat()}"
+
+def window_days(date):
+    return [date - datetime.timedelta(days=n) for n in range(WINDOW_DAYS)]
+
+# Daily sets expire a fixed time after their day rather than after their last
+# update, so a late import cannot keep an old day alive
+def daily_expiry(date):
+    expiry = datetime.datetime.combine(date + datetime.timedelta(days=DAILY_RETENTION_DAYS), datetime.time())
+    return int(expiry.timestamp())
 
-    return players_and_streaks
+def is_retained(date, today=None):
+    today = today or datetime.date.today()
+    return today - datetime.timedelta(days=DAILY_RETENTION_DAYS) < date <= today
 
-def get_top_wins_shard(shardnum):
-    sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
-    sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
-    game_connection = sqlite3.connect(f'./var/games{str(shardnum)}.db', detect_types=sqlite3.PARSE_DECLTYPES)
-    game_cur = game_connection.cursor()
+# Keep a player's entries current after one of their games is recorded.
+# Scores are set from their summary rather than incremented, so replaying
+# an update cannot double count. A won game also counts towards the daily
+# board of the day it finished.
+def update_player(client_redis, username, stats, won_on=None):
+    update_players(client_redis, {username: stats}, [(username, won_on)] if won_on else [])
 
-    user_connection = sqlite3.connect('./var/users.db', detect_types=sqlite3.PARSE_DECLTYPES)
-    user_cur = user_connection.cursor()
+# The same for many players in one round trip; players maps usernames to
+# their summaries and wins lists (username, finished) for each won game
+def update_players(client_redis, players, wins=()):
+    totals = {username: stats['won'] for username, stats in players.items() if stats['won'] > 0}
+    streaks = {username: stats['max_streak'] for username, stats in players.items() if stats['max_streak'] > 0}
+    pipe = client_redis.pipeline(transaction=False)
+    if players:
+        pipe.sadd(TOUCHED_KEY, *players)
+    if totals:
+        pipe.zadd("wins", totals)
+    if streaks:
+        pipe.zadd("streaks", streaks)
+    for username, finished in wins:
+        if is_retained(finished):
+            pipe.zincrby(daily_key(finished), 1, username)
+            pipe.expireat(daily_key(finished), daily_expiry(finished))
+    pipe.execute()
 
-    wins = game_cur.execute("SELECT * FROM wins LIMIT 10").fetchall()
+# The sorted set holding a board over a window. The weekly union is rebuilt
+# once it expires.
+def board_key(client_redis, board, window="all", date=None):
+    if window == "all":
+        return board
+    date = date or datetime.date.today()
+    if window == "daily":
+        return daily_key(date)
+    key = weekly_key(date)
+    if not client_redis.exists(key):
+        pipe = client_redis.pipeline(transaction=True)
+        pipe.zunionstore(key, [daily_key(day) for day in window_days(date)])
+        pipe.expire(key, WEEKLY_TTL)
+        pipe.execute()
+    return key
 
-    players_and_wins = []
+# Cursors name the last entry returned. The next page starts after it if
+# its score is unchanged, or after every higher score if it moved, which can
+# repeat tied players but never skips one whose score did not change.
+PAGE_SCRIPT = """
+local start = 0
+if ARGV[2] ~= '' then
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[2])
+    if score and tonumber(score) == tonumber(ARGV[1]) then
+        start = redis.call('ZREVRANK', KEYS[1], ARGV[2]) + 1
+    else
+        start = redis.call('ZCOUNT', KEYS[1], '(' .. ARGV[1], '+inf')
+    end
+end
+return {start, redis.call('ZREVRANGE', KEYS[1], start, start + tonumber(ARGV[3]) - 1, 'WITHSCORES')}
+"""
 
-    for user in wins:
-        player = user_cur.execute("SELECT * FROM users WHERE user_id = ? LIMIT 1", [user[0]]).fetchall()
-        username = player[0][1]
-        num_win = user[1]
-        players_and_wins.append({"username" : username, "wins" : num_win})
+# A player's rank and score with the players just above and below them
+AROUND_SCRIPT = """
+local rank = redis.call('ZREVRANK', KEYS[1], ARGV[1])
+if not rank then
+    return false
+end
+local first = math.max(rank - tonumber(ARGV[2]), 0)
+return {first, redis.call('ZREVRANGE', KEYS[1], first, rank + tonumber(ARGV[2]), 'WITHSCORES')}
+"""
 
+def encode_cursor(score, username):
+    return base64.urlsafe_b64encode(json.dumps([score, username]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        score, username = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(score), str(username)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+# Ranks count from 1 and tied players share the order Redis gives them
+def ranked(first, members):
+    return [
+        {"rank": first + n + 1, "username": members[2 * n].decode('utf-8'), "score": float(members[2 * n + 1])}
+        for n in range(len(members) // 2)
+    ]
+
+# page_script and around_script are PAGE_SCRIPT and AROUND_SCRIPT registered
+# with the caller's client
+def page(page_script, key, limit, cursor=None):
+    score, username = decode_cursor(cursor) if cursor else (0, "")
+    first, members = page_script(keys=[key], args=[score, username, limit])
+    entries = ranked(first, members)
+    next_cursor = None
+    if len(entries) == limit:
+        next_cursor = encode_cursor(entries[-1]["score"], entries[-1]["username"])
+    return entries, next_cursor
+
+def around(around_script, key, username, neighbors):
+    result = around_script(keys=[key], args=[username, neighbors])
+    if result is None:
+        return None
+    first, members = result
+    return ranked(first, members)
+
+def connect(database):
+    return sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
+
+# Without a limit, every player with a streak or win is returned
+def get_top_streaks_shard(database, limit=None):
+    game_connection = connect(database)
+    streaks = game_connection.execute(
+        "SELECT user_id, max_streak FROM user_stats WHERE max_streak > 0 ORDER BY max_streak DESC LIMIT ?",
+        [-1 if limit is None else limit]
+    ).fetchall()
+    game_connection.close()
+    return streaks
+
+def get_top_wins_shard(database, limit=None):
+    game_connection = connect(database)
+    wins = game_connection.execute(
+        "SELECT user_id, won FROM user_stats WHERE won > 0 ORDER BY won DESC LIMIT ?",
+        [-1 if limit is None else limit]
+    ).fetchall()
     game_connection.close()
+    return wins
+
+# Wins and streaks of the given users found in a shard
+def get_players_shard(database, user_ids):
+    players = []
+    game_connection = connect(database)
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        batch = user_ids[i:i + BATCH_SIZE]
+        placeholders = ", ".join("?" * len(batch))
+        players += game_connection.execute(
+            f"SELECT user_id, won, max_streak FROM user_stats WHERE user_id IN ({placeholders})", batch
+        ).fetchall()
+    game_connection.close()
+    return players
+
+# Wins per user and day since a date, for the daily boards
+def get_daily_wins_shard(database, since):
+    game_connection = connect(database)
+    wins = game_connection.execute(
+        "SELECT user_id, finished, COUNT(*) FROM games WHERE won AND finished >= ? GROUP BY user_id, finished",
+        [since]
+    ).fetchall()
+    game_connection.close()
+    return wins
+
+def get_usernames(user_ids, database):
+    user_ids = list(set(user_ids))
+    usernames = {}
+    user_connection = connect(database)
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        batch = user_ids[i:i + BATCH_SIZE]
+        placeholders = ", ".join("?" * len(batch))
+        for user_id, username in user_connection.execute(
+            f"SELECT user_id, username FROM users WHERE user_id IN ({placeholders})", batch
+        ):
+            usernames[user_id] = username
     user_connection.close()
-    return players_and_wins
+    return usernames
+
+def get_user_ids(usernames, database):
+    usernames = list(set(usernames))
+    user_ids = []
+    user_connection = connect(database)
+    for i in range(0, len(usernames), BATCH_SIZE):
+        batch = usernames[i:i + BATCH_SIZE]
+        placeholders = ", ".join("?" * len(batch))
+        user_ids += [row[0] for row in user_connection.execute(
+            f"SELECT user_id FROM users WHERE username IN ({placeholders})", batch
+        )]
+    user_connection.close()
+    return user_ids
+
+def scatter(func, databases, *args):
+    with ThreadPoolExecutor(max_workers=len(databases)) as executor:
+        results = executor.map(lambda database: func(database, *args), databases)
+        return [row for rows in results for row in rows]
+
+# Build each sorted set under a temporary key and rename it over the live one,
+# so readers never see a partially written leaderboard
+def replace_sorted_set(pipe, key, members):
+    staging = f"{key}:staging"
+    pipe.delete(staging)
+    if members:
+        members = list(members.items())
+        for i in range(0, len(members), ZADD_BATCH_SIZE):
+            pipe.zadd(staging, dict(members[i:i + ZADD_BATCH_SIZE]))
+        pipe.rename(staging, key)
+    else:
+        pipe.delete(key)
+
+# Replace the daily board of every day from since to today that is still
+# retained
+def replace_daily_boards(pipe, daily, usernames, since, today):
+    days = {}
+    for user_id, finished, won in daily:
+        days.setdefault(finished, {})[usernames[user_id]] = won
+    day = max(since, today - datetime.timedelta(days=DAILY_RETENTION_DAYS - 1))
+    while day <= today:
+        replace_sorted_set(pipe, daily_key(day), days.get(day, {}))
+        pipe.expireat(daily_key(day), daily_expiry(day))
+        day += datetime.timedelta(days=1)
+
+def refresh(client_redis, databases, users_database, limit, today):
+    # Every player is rescanned, so none is left to the next incremental run
+    client_redis.delete(TOUCHED_KEY, DRAINING_KEY)
+    since = today - datetime.timedelta(days=DAILY_RETENTION_DAYS - 1)
+    streaks = scatter(get_top_streaks_shard, databases, limit)
+    wins = scatter(get_top_wins_shard, databases, limit)
+    daily = scatter(get_daily_wins_shard, databases, since)
+    usernames = get_usernames([user_id for user_id, _ in streaks + wins] + [user_id for user_id, _, _ in daily], users_database)
+
+    pipe = client_redis.pipeline(transaction=True)
+    replace_sorted_set(pipe, "streaks", {usernames[user_id]: streak for user_id, streak in streaks})
+    replace_sorted_set(pipe, "wins", {usernames[user_id]: won for user_id, won in wins})
+    replace_daily_boards(pipe, daily, usernames, since, today)
+    pipe.execute()
+    return len(streaks), len(wins)
+
+# Rescan the players recorded since the last run, by when their games were
+# written rather than when they finished, so imported and write-behind games
+# with older dates are included. Players left by a run that failed are taken
+# again. The daily boards are rebuilt for every retained day for the same
+# reason.
+def refresh_incremental(client_redis, databases, users_database, limit, today):
+    pipe = client_redis.pipeline(transaction=True)
+    pipe.sunionstore(DRAINING_KEY, [DRAINING_KEY, TOUCHED_KEY])
+    pipe.delete(TOUCHED_KEY)
+    pipe.execute()
+    touched = [username.decode('utf-8') for username in client_redis.smembers(DRAINING_KEY)]
+
+    since = today - datetime.timedelta(days=DAILY_RETENTION_DAYS - 1)
+    players = scatter(get_players_shard, databases, get_user_ids(touched, users_database))
+    daily = scatter(get_daily_wins_shard, databases, since)
+    usernames = get_usernames([user_id for user_id, _, _ in players + daily], users_database)
+
+    pipe = client_redis.pipeline(transaction=True)
+    streaks = {usernames[user_id]: streak for user_id, _, streak in players if streak > 0}
+    wins = {usernames[user_id]: won for user_id, won, _ in players if won > 0}
+    for key, members in [("streaks", streaks), ("wins", wins)]:
+        if members:
+            pipe.zadd(key, members)
+        if limit is not None:
+            pipe.zremrangebyrank(key, 0, -limit * len(databases) - 1)
+    replace_daily_boards(pipe, daily, usernames, since, today)
+    pipe.delete(DRAINING_KEY)
+    pipe.execute()
+    return len(streaks), len(wins)
 
 def main():
+    parser = argparse.ArgumentParser(description="Reconcile the streaks and wins leaderboards in Redis with the shards")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only rescan users with games recorded since the last run")
+    parser.add_argument('--limit', type=int, help="only keep the top entries from each shard")
+    parser.add_argument('--users', default='./var/users.db')
+    parser.add_argument('--replicas', action='store_true', help="read from the shard replicas while they are fresh")
+    parser.add_argument('--max-staleness', type=float, default=60.0)
+    args = parser.parse_args()
+
     client_redis = redis.Redis()
-    for i in range (1, 4):
-        for player in get_top_streaks_shard(i):
-            client_redis.zadd("streaks", {player['username'] : player['streaks']})
-        for player in get_top_wins_shard(i):
-            client_redis.zadd("wins", {player['username'] : player['wins']})
+    router = shardrouter.from_env()
+    databases = router.databases
+    if args.replicas:
+        template = os.environ.get('REPLICA_DATABASE', replicate.REPLICA_DATABASE)
+        databases = replicate.ReplicaSet(router, template, args.max_staleness).databases
+    today = datetime.date.today()
+
+    last_run = client_redis.get(LAST_RUN_KEY)
+    if args.incremental and last_run:
+        streaks, wins = refresh_incremental(client_redis, databases, args.users, args.limit, today)
+    else:
+        streaks, wins = refresh(client_redis, databases, args.users, args.limit, today)
+    client_redis.set(LAST_RUN_KEY, today.isoformat())
+
+    print(f"Stored {streaks} streaks and {wins} wins")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Load generator for the whole game flow, through Traefik.
+# Each session starts a game for a random user with /req/new and guesses
+# until it wins or runs out of guesses with /req/guess, then reads the
+# player's statistics and both leaderboards. Guesses are random words from
+# words.sql, with the game's answer from answers.sql played at a set rate so
+# sessions win, lose and build streaks like real players.
+#
+# Start the services and Redis with foreman (see the README), then:
+#
+#     ./loadgen.py [--url http://localhost:9999] [--sessions 500] [--concurrency 20]
+#
+# The stats scenario only reads statistics: each session reads a random
+# player's statistics and every tenth also reads the global statistics. Give
+# --stats-url once per stats instance to spread the reads over them, e.g. to
+# compare one instance with three:
+#
+#     ./loadgen.py --scenario stats --stats-url http://localhost:5200 --stats-url http://localhost:5201 ...
+#
+# Reports throughput, p50/p95/p99 latency and errors for each endpoint.
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+import httpx
+
+import bench
+
+# Requests are grouped under these names in the report
+ENDPOINTS = ['req/new', 'req/guess', 'stats/users', 'stats/leaders/wins', 'stats/leaders/streaks']
+STATS_ENDPOINTS = ['stats/users', 'stats/global']
+
+
+class Recorder:
+    def __init__(self, endpoints=ENDPOINTS):
+        self.endpoints = endpoints
+        self.latencies = {endpoint: [] for endpoint in endpoints}
+        self.errors = {endpoint: 0 for endpoint in endpoints}
+        self.sessions = 0
+        self.wins = 0
+
+    async def request(self, client, endpoint, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            r = await client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            self.errors[endpoint] += 1
+            return None
+        finally:
+            self.latencies[endpoint].append((time.perf_counter() - start) * 1000)
+        # req.py passes errors from the other services back in the body
+        if r.is_error or (r.headers.get('content-type', '').startswith('application/json') and 'detail' in r.json()):
+            self.errors[endpoint] += 1
+            return None
+        return r
+
+
+async def play_session(client, recorder, words, answers, usernames, win_rate):
+    r = await recorder.request(client, 'req/new', 'POST', '/req/new', params={'username': random.choice(usernames)})
+    if r is None:
+        return
+    game = r.json()
+    answer = answers.get(game['game_id'])
+
+    for _ in range(6):
+        guess = answer if answer and random.random() < win_rate else random.choice(words)
+        r = await recorder.request(client, 'req/guess', 'POST', '/req/guess', params={
+            'user_id': game['user_id'], 'game_id': game['game_id'], 'guess': guess,
+        })
+        if r is None:
+            break
+        if guess == answer:
+            recorder.wins += 1
+            break
+
+    await recorder.request(client, 'stats/users', 'GET', f"/stats/users/{game['user_id']}")
+    await recorder.request(client, 'stats/leaders/wins', 'GET', '/stats/leaders/wins/')
+    await recorder.request(client, 'stats/leaders/streaks', 'GET', '/stats/leaders/streaks/')
+    recorder.sessions += 1
+
+
+async def read_stats(client, recorder, user_ids, session):
+    await recorder.request(client, 'stats/users', 'GET', f"users/{random.choice(user_ids)}")
+    if session % 10 == 0:
+        await recorder.request(client, 'stats/global', 'GET', 'global')
+    recorder.sessions += 1
+
+
+async def run_stats(args):
+    user_ids = bench.load_user_ids(args.users)
+    recorder = Recorder(STATS_ENDPOINTS)
+    sessions = iter(range(args.sessions))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    # Each worker sends its sessions to the next instance in turn
+    clients = [
+        httpx.AsyncClient(base_url=url.rstrip('/') + '/', timeout=args.timeout, limits=limits)
+        for url in args.stats_url
+    ]
+    instances = itertools.cycle(clients)
+
+    async def worker():
+        for session in sessions:
+            await read_stats(next(instances), recorder, user_ids, session)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        await client.aclose()
+
+    return recorder, elapsed
+
+
+async def run(args):
+    words = bench.load_words(args.words)
+    # Answers are numbered by game_id in the order answers.sql inserts them
+    answers = {game_id: answer for game_id, answer in enumerate(bench.load_words(args.answers), start=1)}
+    usernames = bench.load_usernames(args.users)
+
+    recorder = Recorder()
+    sessions = iter(range(args.sessions))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        async def worker():
+            for _ in sessions:
+                await play_session(client, recorder, words, answers, usernames, args.win_rate)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return recorder, elapsed
+
+
+def report(recorder, elapsed):
+    rows = []
+    for endpoint in recorder.endpoints:
+        stats = bench.summarize(recorder.latencies[endpoint])
+        rows.append({
+            "endpoint": endpoint,
+            **stats,
+            "errors": recorder.errors[endpoint],
+            "per_sec": round(stats["count"] / elapsed, 1),
+        })
+    total = sum(row["count"] for row in rows)
+    return {
+        "sessions": recorder.sessions,
+        "wins": recorder.wins,
+        "seconds": round(elapsed, 2),
+        "requests": total,
+        "requests_per_sec": round(total / elapsed, 1),
+        "errors": sum(row["errors"] for row in rows),
+        "endpoints": rows,
+    }
+
+
+def print_report(summary):
+    print(f"{'endpoint':<24}{'count':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for row in summary["endpoints"]:
+        print(f"{row['endpoint']:<24}{row['count']:>8}{row['per_sec']:>9}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['errors']:>8}")
+    print(f"\n{summary['sessions']} sessions ({summary['wins']} won), {summary['requests']} requests "
+          f"in {summary['seconds']}s: {summary['requests_per_sec']} req/s, {summary['errors']} errors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play games through req.py and report latency per endpoint")
+    parser.add_argument('--scenario', choices=['game', 'stats'], default='game')
+    parser.add_argument('--url', default='http://localhost:9999', help="Traefik, in front of every service")
+    parser.add_argument('--stats-url', action='append',
+                        help="stats instances for the stats scenario (default: http://localhost:9999/stats)")
+    parser.add_argument('--sessions', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=20, help="sessions played at once")
+    parser.add_argument('--win-rate', type=float, default=0.3,
+                        help="chance of playing the answer on each guess")
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--words', default='./share/words.sql')
+    parser.add_argument('--answers', default='./share/answers.sql')
+    parser.add_argument('--users', default='./var/users.db')
+    parser.add_argument('--seed', type=int, help="repeat the same sessions")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.scenario == 'stats':
+        args.stats_url = args.stats_url or ['http://localhost:9999/stats']
+        summary = report(*asyncio.run(run_stats(args)))
+    else:
+        summary = report(*asyncio.run(run(args)))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+
+if __name__ == '__main__':
+    main()
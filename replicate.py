@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Read-only replicas of the games shards.
+# This program copies every shard to its replica with SQLite's online backup
+# API every --interval seconds. Each copy is one write transaction on the
+# replica, so readers keep seeing the previous snapshot until it commits.
+# After each copy it writes the time the snapshot was taken to a stamp file
+# next to the replica (games1.db.stamp).
+#
+# The services read from a replica only while its stamp is at most
+# REPLICA_MAX_STALENESS seconds old and newer than the last write they know
+# of for the user. Otherwise they read the shard itself. Writes always go to
+# the shards.
+#
+#     REPLICA_DATABASE=./var/replicas/games{}.db ./replicate.py [--interval 2.0] [--once]
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+import shardrouter
+
+REPLICA_DATABASE = './var/replicas/games{}.db'
+
+# How often the services reread a stamp file
+STAMP_CHECK_INTERVAL = 0.5
+
+
+def stamp_path(replica):
+    return replica + '.stamp'
+
+
+def read_stamp(replica):
+    try:
+        with open(stamp_path(replica)) as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_stamp(replica, taken):
+    temporary = stamp_path(replica) + '.tmp'
+    with open(temporary, 'w') as f:
+        f.write(repr(taken))
+    os.replace(temporary, stamp_path(replica))
+
+
+# Copy primary over replica in one step and stamp it with the time the copy
+# started, which no write in the snapshot can be newer than
+def snapshot(primary, replica):
+    taken = time.time()
+    source = sqlite3.connect(primary)
+    target = sqlite3.connect(replica)
+    try:
+        target.execute('PRAGMA busy_timeout = 5000')
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    write_stamp(replica, taken)
+    return taken
+
+
+# Where each shard's reads go. Replicas are used while fresh; with no
+# template every read goes to the shards.
+class ReplicaSet:
+    def __init__(self, router, template=None, max_staleness=5.0):
+        self.router = router
+        self.max_staleness = max_staleness
+        self.replicas = [template.format(shard) for shard in router.shards] if template else []
+        self._stamps = {}
+        self._lock = threading.Lock()
+        self.reads = {"replica": 0, "primary": 0}
+
+    # The stamp of a replica, reread at most every STAMP_CHECK_INTERVAL
+    def stamp(self, replica):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._stamps.get(replica)
+        if cached is not None and now - cached[0] < STAMP_CHECK_INTERVAL:
+            return cached[1]
+        stamp = read_stamp(replica)
+        with self._lock:
+            self._stamps[replica] = (now, stamp)
+        return stamp
+
+    def _choose(self, shard, written_at=None):
+        if self.replicas:
+            replica = self.replicas[shard - 1]
+            stamp = self.stamp(replica)
+            if stamp is not None and time.time() - stamp <= self.max_staleness \
+                    and (written_at is None or stamp > written_at):
+                with self._lock:
+                    self.reads["replica"] += 1
+                return replica
+        with self._lock:
+            self.reads["primary"] += 1
+        return self.router.databases[shard - 1]
+
+    # The database to read a user's games from. written_at is when the
+    # caller last saw the user written; a replica older than that is skipped.
+    def database_for(self, user_id, written_at=None):
+        return self._choose(self.router.shard_for(user_id), written_at)
+
+    # The database to read each shard from, for queries over every shard
+    @property
+    def databases(self):
+        return [self._choose(shard) for shard in self.router.shards]
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            reads = dict(self.reads)
+        ages = {}
+        for replica in self.replicas:
+            stamp = self.stamp(replica)
+            ages[replica] = round(now - stamp, 3) if stamp is not None else None
+        return {"max_staleness": self.max_staleness, "reads": reads, "replica_age_seconds": ages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep snapshot replicas of the games shards")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between snapshots")
+    parser.add_argument('--once', action='store_true', help="take one snapshot of every shard and exit")
+    args = parser.parse_args()
+
+    router = shardrouter.from_env()
+    template = os.environ.get('REPLICA_DATABASE', REPLICA_DATABASE)
+    replicas = [template.format(shard) for shard in router.shards]
+    for replica in replicas:
+        os.makedirs(os.path.dirname(replica) or '.', exist_ok=True)
+
+    print(f"Copying {len(replicas)} shards to {template} every {args.interval}s")
+    while True:
+        start = time.perf_counter()
+        for primary, replica in zip(router.databases, replicas):
+            snapshot(primary, replica)
+        elapsed = time.perf_counter() - start
+        if args.once:
+            print(f"Copied {len(replicas)} shards in {elapsed:.2f}s")
+            break
+        if elapsed > args.interval:
+            print(f"Copying the shards took {elapsed:.2f}s, longer than the {args.interval}s interval")
+        time.sleep(max(args.interval - elapsed, 0.0))
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,330 @@
 import asyncio
+import datetime
 import httpx
-import random
 import contextlib
 import logging.config
 import json
+import redis
+import time
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Response, status
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel, BaseSettings
+from starlette.concurrency import run_in_threadpool
 
+import instrument
+import schedule
+
+class Settings(BaseSettings):
+  # Call the dict, state and guess services in-process instead of over HTTP
+  colocated: bool = False
+
+  logging_config: str = "./etc/logging.ini"
+
+  # Game 1 is played on answer_epoch and one game each day after it
+  answer_database: str = "./var/answers.db"
+  answer_epoch: datetime.date = datetime.date(2021, 6, 19)
+  # Answers pushed to the checkguess workers ahead of their day
+  schedule_days: int = 2
+  # Warn when the answers will run out and start again from game 1
+  schedule_warning_days: int = 30
+
+  api_url: str = "http://localhost:9999"
+  connect_timeout: float = 2.0
+  read_timeout: float = 5.0
+  max_connections: int = 100
+  max_keepalive_connections: int = 20
+
+  class Config:
+    env_file = ".env"
+
+settings = Settings()
+client_redis = instrument.instrument_redis(redis.Redis())
 app = FastAPI(root_path="/req")
+instrument.instrument(app)
+
+instrument.configure_logging(settings.logging_config)
+
+# One pooled client shared by every request so connections are kept alive
+client = None
+
+@app.on_event("startup")
+async def open_client():
+  global client
+  client = httpx.AsyncClient(
+    base_url=settings.api_url,
+    timeout=httpx.Timeout(settings.read_timeout, connect=settings.connect_timeout),
+    limits=httpx.Limits(
+      max_connections=settings.max_connections,
+      max_keepalive_connections=settings.max_keepalive_connections,
+    ),
+  )
+
+@app.on_event("shutdown")
+async def close_client():
+  await client.aclose()
+
+def get_logger():
+  return logging.getLogger(__name__)
+
+# The services a guess goes through, reached over HTTP through Traefik
+class HttpServices:
+  mode = 'http'
+
+  def validate(self, guess):
+    return client.get('/dict/validate', params={'guess': f'{guess}'})
+
+  def check(self, game_id, guess):
+    return client.get('/guess/check', params={'game_id': game_id, 'guess': guess})
+
+  def update(self, user_id, game_id, guess):
+    return client.post('/games/update', params={'user_id': user_id,'game_id': game_id, 'guess': guess})
+
+  def start(self, username, game_id):
+    return client.post('/games/start', params={'username': f'{username}', 'game_id': game_id})
+
+  def finish(self, user_id, game_id, won):
+    return client.post('/games/finish', params={'user_id': user_id, 'game_id': game_id, 'won': won})
+
+  def restore(self, user_id, game_id):
+    return client.get('/games/restore', params={'user_id': user_id, 'game_id': game_id})
+
+# The same services imported and called directly when they are co-located
+# with this one. Replies are wrapped as httpx responses so callers handle
+# both modes the same way.
+class LocalServices:
+  mode = 'colocated'
+
+  def __init__(self):
+    import checkguess
+    import trackgamestate
+    import validateguess
+
+    validateguess.load_dictionary()
+    checkguess.load_answers()
+    checkguess.start_answer_updates()
+    trackgamestate.start_user_directory()
+    self.checkguess = checkguess
+    self.trackgamestate = trackgamestate
+    self.validateguess = validateguess
+
+  async def call(self, func, *args, blocking=False):
+    try:
+      if blocking:
+        result = await run_in_threadpool(func, *args)
+      else:
+        result = func(*args)
+    except HTTPException as e:
+      return httpx.Response(e.status_code, json={'detail': e.detail}, headers=e.headers)
+    return httpx.Response(200, json=jsonable_encoder(result))
+
+  def validate(self, guess):
+    return self.call(self.validateguess.validate_guess, guess)
+
+  def check(self, game_id, guess):
+    return self.call(self.checkguess.check_guess, game_id, guess)
+
+  def update(self, user_id, game_id, guess):
+    return self.call(self.trackgamestate.update_game, user_id, game_id, guess, blocking=True)
+
+  def start(self, username, game_id):
+    return self.call(self.trackgamestate.start_game, username, game_id, blocking=True)
+
+  def finish(self, user_id, game_id, won):
+    return self.call(self.trackgamestate.finish_game, user_id, game_id, won, blocking=True)
+
+  def restore(self, user_id, game_id):
+    return self.call(self.trackgamestate.retrieve_game, user_id, game_id, blocking=True)
+
+services = HttpServices()
+
+@app.on_event("startup")
+def choose_services():
+  global services
+  if not settings.colocated:
+    return
+  try:
+    services = LocalServices()
+  except Exception:
+    get_logger().exception("Co-located services unavailable, falling back to HTTP")
+
+# The schedule is loaded and checked against answers.db before any game starts,
+# then follows the answers added or changed through checkguess
+answer_schedule = None
+publisher = None
+answer_updates = None
+answer_listener = None
+
+def on_answer(message):
+  try:
+    answer_schedule.set(*schedule.parse_answer(message))
+  except (ValueError, KeyError):
+    get_logger().warning("Ignoring answer update %r", message['data'])
+
+@app.on_event("startup")
+async def load_schedule():
+  global answer_schedule, publisher, answer_updates, answer_listener
+  answer_schedule = schedule.AnswerSchedule.load(settings.answer_database, settings.answer_epoch)
+  days_left = answer_schedule.days_left()
+  get_logger().info(
+    "Today is game %d of %d, %d days before the answers repeat",
+    answer_schedule.game_id(), len(answer_schedule), days_left,
+  )
+  if days_left <= settings.schedule_warning_days:
+    get_logger().warning("The answers repeat from game 1 in %d days; add more answers", days_left)
+  publisher = asyncio.create_task(publish_daily())
+
+  answer_updates = client_redis.pubsub(ignore_subscribe_messages=True)
+  answer_updates.subscribe(**{schedule.CHANNEL: on_answer})
+  answer_listener = answer_updates.run_in_thread(sleep_time=1.0, daemon=True)
+
+@app.on_event("shutdown")
+async def stop_publisher():
+  if publisher is not None:
+    publisher.cancel()
+  if answer_listener is not None:
+    answer_listener.stop()
+  if answer_updates is not None:
+    answer_updates.close()
+
+def publish_upcoming():
+  upcoming = answer_schedule.upcoming(settings.schedule_days)
+  try:
+    schedule.publish_answers(client_redis, [(game_id, answer) for _, game_id, answer in upcoming])
+  except redis.RedisError:
+    get_logger().warning("Could not publish the answers for games %s", [game_id for _, game_id, _ in upcoming])
+
+# Publish the coming answers now and again after every midnight
+async def publish_daily():
+  while True:
+    await run_in_threadpool(publish_upcoming)
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    await asyncio.sleep((midnight - now).total_seconds() + 1)
+
+# Today's game; the answers stay with checkguess
+@app.get("/today")
+def today():
+  return {
+    'date': datetime.date.today(),
+    'game_id': answer_schedule.game_id(),
+    'days_left': answer_schedule.days_left(),
+  }
+
+# Latency of each hop to the other services
+hops = {}
+hop_seconds = instrument.Histogram("req_hop_duration_seconds", "Calls from req to the other services", ("hop", "mode"))
+
+async def timed(timings, hop, request):
+  start = time.perf_counter()
+  try:
+    return await request
+  finally:
+    elapsed = (time.perf_counter() - start) * 1000
+    timings[hop] = elapsed
+    stats = hops.setdefault(hop, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+    stats['count'] += 1
+    stats['total_ms'] += elapsed
+    stats['max_ms'] = max(stats['max_ms'], elapsed)
+    hop_seconds.observe(elapsed / 1000, hop, services.mode)
+
+def server_timing(timings):
+  return ', '.join(f'{hop};dur={elapsed:.2f}' for hop, elapsed in timings.items())
+
+@app.get("/latency")
+def hop_latency():
+  return {
+    'mode': services.mode,
+    'hops': {hop: {**stats, 'avg_ms': stats['total_ms'] / stats['count']} for hop, stats in hops.items()},
+  }
 
 # Start new game
 @app.post("/new", status_code=200)
-def startGame(username:str):
-  x = random.randint(1,2111)
-  params = {'username': f'{username}', 'game_id': x}
-  r = httpx.post('http://localhost:9999/games/start', params=params)
+async def startGame(username:str, response: Response):
+  timings = {}
+  r = await timed(timings, 'start', services.start(username, answer_schedule.game_id()))
+  response.headers['Server-Timing'] = server_timing(timings)
+  # Unknown players, and today's game already started or played
+  if r.is_error:
+    response.status_code = r.status_code
+    return r.json()
   return {'status': 'new', 'user_id': r.json()['user_id'], 'game_id': r.json()['game_id']}
 
 @app.post("/guess")
-def newGuess(user_id:str, game_id:int, guess:str):
-  # Validate the guess
-  params = {'guess': f'{guess}'}
-  r = httpx.get('http://localhost:9999/dict/validate', params=params)
-  code = r.status_code
-  if code == 400:
-    return r.json()
+async def newGuess(user_id:str, game_id:int, guess:str, response: Response):
+  timings = {}
+
+  # Validate the guess and check it against the answer at the same time
+  valid, answer = await asyncio.gather(
+    timed(timings, 'validate', services.validate(guess)),
+    timed(timings, 'check', services.check(game_id, guess)),
+  )
+  response.headers['Server-Timing'] = server_timing(timings)
+  if valid.status_code == 400:
+    return valid.json()
+  # An unknown game or a malformed guess is refused before it spends a guess
+  if answer.is_error:
+    return answer.json()
 
+  # A winning guess already in the game is a retry of a win whose finish was
+  # refused; finish it again instead of spending another guess
+  if is_win(answer):
+    g = await timed(timings, 'restore', services.restore(user_id, game_id))
+    if not g.is_error and guess.lower() in recorded_guesses(g):
+      result = {'remaining': g.json()['remain_guess'], **answer.json(), 'status': 'won'}
+      return await finish(timings, user_id, game_id, True, result, response)
 
   # Record guess and updates guesses remaining
-  params = {'user_id': user_id,'game_id': game_id, 'guess': guess}
-  r = httpx.post(f'http://localhost:9999/games/update', params=params)
-  if r.status_code == 400:
+  r = await timed(timings, 'update', services.update(user_id, game_id, guess))
+  response.headers['Server-Timing'] = server_timing(timings)
+  if r.status_code == status.HTTP_400_BAD_REQUEST:
+    return await finish_again(timings, user_id, game_id, r, response)
+  if r.is_error:
     return r.json()
-  params = {'game_id': game_id, 'guess': guess}
-  answer = httpx.get('http://localhost:9999/guess/check', params=params)
 
-  return {'remaining': r.json()['remain_guess'],**answer.json()}
+  # A won or lost game is handed to trackgamestate, which queues it to be
+  # recorded in the statistics shards
+  remaining = r.json()['remain_guess']
+  won = is_win(answer)
+  if not won and remaining > 0:
+    return {'remaining': remaining, **answer.json()}
+
+  result = {'remaining': remaining, **answer.json(), 'status': 'won' if won else 'lost'}
+  return await finish(timings, user_id, game_id, won, result, response)
+
+def is_win(answer):
+  return [list(letter) for letter in answer.json()['response']] == [['correct']] * 5
+
+def recorded_guesses(game):
+  return [game.json()[f'guess{n}'] for n in range(1, 7) if game.json()[f'guess{n}']]
+
+# Queue a won or lost game. When trackgamestate refuses it, e.g. with 503 and
+# Retry-After while the write-behind backlog is full, the caller gets the same
+# status and can send the guess again.
+async def finish(timings, user_id, game_id, won, result, response):
+  f = await timed(timings, 'finish', services.finish(user_id, game_id, won))
+  response.headers['Server-Timing'] = server_timing(timings)
+  if f.is_error:
+    get_logger().warning("Game %s of %s was not recorded: %s", game_id, user_id, f.text)
+    response.status_code = f.status_code
+    if 'retry-after' in f.headers:
+      response.headers['Retry-After'] = f.headers['retry-after']
+    return {**result, **f.json(), 'recorded': False}
+  return {**result, 'remaining': 0, 'recorded': True}
+
+# A guess refused by update may be the retry of a game whose finish was
+# refused: it has no guesses left but was never queued. Finish it again from
+# its last guess; trackgamestate queues each game only once, so a game
+# already recorded is unchanged. The guess itself is still refused.
+async def finish_again(timings, user_id, game_id, r, response):
+  g = await timed(timings, 'restore', services.restore(user_id, game_id))
+  if g.is_error or g.json()['remain_guess'] > 0:
+    return r.json()
+  last = await timed(timings, 'check', services.check(game_id, recorded_guesses(g)[-1]))
+  if last.is_error:
+    return r.json()
+  won = is_win(last)
+  return await finish(timings, user_id, game_id, won, {**r.json(), 'status': 'won' if won else 'lost'}, response)
 
 
 
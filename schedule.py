@@ -0,0 +1,90 @@
+# Daily answer schedule.
+# Game n is played on day n - 1 counted from the epoch, so the game of any day
+# is derived from the date alone. The answers are read from answers.db once
+# and kept in memory; when every game has been played the schedule starts
+# again from game 1.
+#
+# req.py publishes the answers of the current and upcoming days on CHANNEL,
+# and every checkguess worker listening stores them in its answer book, so
+# neither starting a game nor scoring a guess reads the database.
+import contextlib
+import datetime
+import json
+import sqlite3
+
+CHANNEL = "answers:updates"
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+def publish_answers(client_redis, answers):
+    pipe = client_redis.pipeline(transaction=False)
+    for game_id, answer in answers:
+        pipe.publish(CHANNEL, json.dumps({"game_id": game_id, "answer": answer}))
+    pipe.execute()
+
+
+def parse_answer(message):
+    update = json.loads(message['data'])
+    return int(update["game_id"]), update["answer"]
+
+
+class AnswerSchedule:
+    def __init__(self, epoch, answers):
+        self.epoch = epoch
+        # Answer of game n at index n - 1
+        self.answers = list(answers)
+
+    # Every game_id from 1 to the number of answers must exist, or some days
+    # would have no game
+    @classmethod
+    def load(cls, database, epoch):
+        with contextlib.closing(sqlite3.connect(database)) as db:
+            rows = db.execute("SELECT game_id, answer FROM answers ORDER BY game_id").fetchall()
+        if not rows:
+            raise ScheduleError(f"No answers in {database}")
+        if rows[0][0] != 1 or rows[-1][0] != len(rows):
+            raise ScheduleError(
+                f"Game ids in {database} run from {rows[0][0]} to {rows[-1][0]}, expected 1 to {len(rows)}"
+            )
+        return cls(epoch, [answer for _, answer in rows])
+
+    # Changes published by checkguess; added answers extend the schedule only
+    # when they follow on from the last game
+    def set(self, game_id, answer):
+        if 1 <= game_id <= len(self.answers):
+            self.answers[game_id - 1] = answer
+        elif game_id == len(self.answers) + 1:
+            self.answers.append(answer)
+
+    def __len__(self):
+        return len(self.answers)
+
+    def day(self, date=None):
+        date = date or datetime.date.today()
+        day = (date - self.epoch).days
+        if day < 0:
+            raise ScheduleError(f"{date} is before the first game on {self.epoch}")
+        return day
+
+    def game_id(self, date=None):
+        return self.day(date) % len(self.answers) + 1
+
+    def answer(self, date=None):
+        return self.answers[self.game_id(date) - 1]
+
+    # (date, game_id, answer) for the given number of days from date
+    def upcoming(self, days, date=None):
+        date = date or datetime.date.today()
+        schedule = []
+        for n in range(days):
+            day = date + datetime.timedelta(days=n)
+            game_id = self.game_id(day)
+            schedule.append((day, game_id, self.answers[game_id - 1]))
+        return schedule
+
+    # Days until the schedule starts again from game 1
+    def days_left(self, date=None):
+        return len(self.answers) - self.day(date) % len(self.answers)
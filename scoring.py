@@ -0,0 +1,105 @@
+# Scoring engine for guesses against the answer list.
+# All answers are kept in memory as a packed uint8 array indexed by game_id
+# (one row of five letter codes per game), so checking a guess never touches
+# the database and many guesses can be scored in one vectorized call.
+import contextlib
+import sqlite3
+
+import numpy as np
+
+ABSENT = 0
+PRESENT = 1
+CORRECT = 2
+
+WORD_LENGTH = 5
+ALPHABET = 26
+
+
+def encode(word):
+    if len(word) != WORD_LENGTH or not word.isascii() or not word.isalpha() or not word.islower():
+        raise ValueError(f"{word} is not a five letter lowercase word")
+    return np.frombuffer(word.encode("ascii"), dtype=np.uint8) - ord("a")
+
+
+def decode(codes):
+    return bytes(np.asarray(codes, dtype=np.uint8) + ord("a")).decode("ascii")
+
+
+def score_codes(answers, guesses):
+    # answers and guesses are (n, 5) arrays of letter codes; returns an (n, 5)
+    # array of ABSENT/PRESENT/CORRECT with duplicate letters counted properly
+    answers = np.asarray(answers, dtype=np.uint8).reshape(-1, WORD_LENGTH)
+    guesses = np.asarray(guesses, dtype=np.uint8).reshape(-1, WORD_LENGTH)
+    rows = np.arange(len(answers))
+
+    correct = answers == guesses
+    result = np.where(correct, CORRECT, ABSENT).astype(np.uint8)
+
+    # Letters of the answer not already matched in place are available
+    # to be marked present, one use each, left to right
+    available = np.zeros((len(answers), ALPHABET), dtype=np.int8)
+    np.add.at(available, (rows[:, None], answers), ~correct)
+
+    for i in range(WORD_LENGTH):
+        letters = guesses[:, i]
+        present = ~correct[:, i] & (available[rows, letters] > 0)
+        result[present, i] = PRESENT
+        available[rows[present], letters[present]] -= 1
+
+    return result
+
+
+class AnswerBook:
+    def __init__(self, answers=()):
+        self.codes = np.zeros((1, WORD_LENGTH), dtype=np.uint8)
+        self.known = np.zeros(1, dtype=bool)
+        for game_id, answer in answers:
+            self.set(game_id, answer)
+
+    @classmethod
+    def load(cls, database):
+        with contextlib.closing(sqlite3.connect(database)) as db:
+            return cls(db.execute("SELECT game_id, answer FROM answers"))
+
+    def __len__(self):
+        return int(self.known.sum())
+
+    def __contains__(self, game_id):
+        return 0 <= game_id < len(self.known) and bool(self.known[game_id])
+
+    def get(self, game_id):
+        if game_id not in self:
+            return None
+        return decode(self.codes[game_id])
+
+    def set(self, game_id, answer):
+        if game_id >= len(self.known):
+            size = max(game_id + 1, 2 * len(self.known))
+            codes = np.zeros((size, WORD_LENGTH), dtype=np.uint8)
+            known = np.zeros(size, dtype=bool)
+            codes[:len(self.codes)] = self.codes
+            known[:len(self.known)] = self.known
+            self.codes, self.known = codes, known
+        self.codes[game_id] = encode(answer)
+        self.known[game_id] = True
+
+    def score(self, game_id, guess):
+        if game_id not in self:
+            return None
+        return score_codes(self.codes[game_id], encode(guess))[0]
+
+    def score_batch(self, game_ids, guesses):
+        # Scores many (game_id, guess) pairs at once. Rows for unknown games
+        # are returned as None.
+        game_ids = np.asarray(game_ids, dtype=np.int64)
+        in_range = (game_ids >= 0) & (game_ids < len(self.known))
+        found = np.zeros(len(game_ids), dtype=bool)
+        found[in_range] = self.known[game_ids[in_range]]
+
+        scores = [None] * len(game_ids)
+        if found.any():
+            encoded = np.stack([encode(guess) for guess in guesses])
+            result = score_codes(self.codes[game_ids[found]], encoded[found])
+            for row, i in zip(result, np.flatnonzero(found)):
+                scores[i] = row
+        return scores
@@ -1,13 +1,54 @@
 #!/usr/bin/env python3
+
+# Split the games in stats.db across the games shards.
+# Games are streamed from stats.db in chunks, partitioned by shard and handed
+# to one loader process per shard (or loaded inline on a single CPU), which
+# bulk inserts them with durability relaxed and builds the indexes and user
+# summaries once the load is done.
+#
+#     ./shard.py [--source ./var/stats.db] [--users ./var/users.db] [--chunk-size 20000] [--workers N]
+import argparse
+import multiprocessing
+import os
+import queue
 import sqlite3
+import time
 import uuid
 
-def create_user_database(users):
+import redis
+
+import bloom
+import shardrouter
+import userdir
+import userstats
+
+CHUNK_SIZE = 20000
+
+# Chunks waiting for each loader; reading pauses when a loader falls behind
+QUEUE_DEPTH = 8
+
+# How often a blocked put or wait checks that the loader processes are alive
+POLL_INTERVAL = 1.0
+
+# Nothing is durable until the load finishes, so a failed load is simply rerun
+LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -262144',
+]
+
+SERVE_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+]
+
+def create_user_database(users, database='./var/users.db'):
     print("Creating and inserting data to users database...\n")
     sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
     sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
 
-    connection = sqlite3.connect('./var/users.db', detect_types=sqlite3.PARSE_DECLTYPES)
+    connection = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
     cur = connection.cursor()
 
     cur.execute('DROP TABLE IF EXISTS users;')
@@ -19,22 +60,24 @@ def create_user_database(users):
     fake_user_name = "project4group4"
     cur.execute('INSERT INTO users VALUES (?,?)', [fake_user_id, fake_user_name])
 
-    for user in users:
-        
-        new_user_id = uuid.uuid4()
-        map_key[user[0]] = new_user_id
-        cur.execute('INSERT INTO users VALUES (?,?)', [new_user_id, user[1]])
+    def new_users():
+        for user in users:
+            new_user_id = uuid.uuid4()
+            map_key[user[0]] = new_user_id
+            yield new_user_id, user[1]
+
+    cur.executemany('INSERT INTO users VALUES (?,?)', new_users())
 
     connection.commit()
     connection.close()
     return map_key
 
-def create_sharding_games(shard_num):
-    print(f"Creating sharding game{shard_num} database...\n")
+def create_sharding_games(database, indexes=True):
+    print(f"Creating sharding {database} database...\n")
     sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
     sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
 
-    connection = sqlite3.connect(f'./var/games{shard_num}.db', detect_types=sqlite3.PARSE_DECLTYPES)
+    connection = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
     cur = connection.cursor()
 
     cur.execute('DROP TABLE IF EXISTS games;')
@@ -45,8 +88,9 @@ def create_sharding_games(shard_num):
                     'guesses INTEGER,'
                     'won BOOLEAN,'
                     'PRIMARY KEY(user_id, game_id));')
-    
-    cur.execute('CREATE INDEX games_won_idx ON games(won);')
+
+    if indexes:
+        create_indexes(connection)
 
     cur.execute('DROP VIEW IF EXISTS wins;')
     cur.execute('CREATE VIEW wins '
@@ -63,97 +107,209 @@ def create_sharding_games(shard_num):
                 'ORDER BY '
                     'COUNT(won) DESC;')
     
+    # Streaks are kept in the streak_runs table rather than computed by a view
     cur.execute('DROP VIEW IF EXISTS streaks;')
-    cur.execute('CREATE VIEW streaks '
-                'AS '
-                    'WITH ranks AS ('
-                        'SELECT DISTINCT '
-                            'user_id,'
-                            'finished, '
-                            'RANK() OVER(PARTITION BY user_id ORDER BY finished) AS rank '
-                        'FROM '
-                            'games '
-                        'WHERE '
-                            'won = TRUE '
-                        'ORDER BY '
-                            'user_id,'
-                            'finished'
-                    '),'
-                    'groups AS ('
-                        'SELECT '
-                            'user_id,'
-                            'finished,'
-                            'rank, '
-                            "DATE(finished, '-' || rank || ' DAYS') AS base_date "
-                        'FROM '
-                            'ranks'
-                    ') '
-                    'SELECT '
-                        'user_id,'
-                        'COUNT(*) AS streak,'
-                        'MIN(finished) AS beginning,'
-                        'MAX(finished) AS ending '
-                    'FROM '
-                        'groups '
-                    'GROUP BY '
-                        'user_id, base_date '
-                    'HAVING '
-                        'streak > 1 '
-                    'ORDER BY '
-                        'user_id,'
-                        'finished;')
+    cur.execute('DROP TABLE IF EXISTS streak_runs;')
+    cur.execute('DROP TABLE IF EXISTS user_stats;')
+    userstats.create_table(connection)
     
     connection.commit()
     connection.close()
 
-def insert_to_shard(game, connection, new_user_id):
-    cur = connection.cursor()
-    cur.execute('INSERT INTO games VALUES (?,?,?,?,?)', [new_user_id, game[1], game[2], game[3], game[4]])
+def create_indexes(connection):
+    connection.execute('CREATE INDEX IF NOT EXISTS games_won_idx ON games(won);')
+    connection.execute('CREATE INDEX IF NOT EXISTS games_finished_idx ON games(finished);')
 
-def main():
+# Bulk loads one shard: every chunk is inserted in a single transaction that
+# is only committed by finish(), which then builds the indexes and user
+# summaries over the finished table
+class ShardLoader:
+    def __init__(self, database):
+        self.database = database
+        self.connection = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
+        for pragma in LOAD_PRAGMAS:
+            self.connection.execute(pragma)
 
-    user_connection = sqlite3.connect('./var/stats.db')
-    user_cur = user_connection.cursor()
-    users = user_cur.execute("SELECT * FROM users")
-    map_key = create_user_database(users)
-    user_connection.close()
+    def load(self, rows):
+        self.connection.executemany('INSERT INTO games VALUES (?,?,?,?,?)', rows)
 
-    for i in range(1, 4):
-        create_sharding_games(str(i))
+    def finish(self):
+        self.connection.commit()
+        create_indexes(self.connection)
+        userstats.rebuild(self.connection)
+        self.connection.execute('ANALYZE')
+        self.connection.commit()
+        for pragma in SERVE_PRAGMAS:
+            self.connection.execute(pragma)
+        self.connection.close()
 
-    game_connection = sqlite3.connect('./var/stats.db')
-    game_cur = game_connection.cursor()
-    
-    print("Sharding games into three different games database...\n")
+# Worker process for one shard when loading in parallel
+def load_shard(database, chunks, progress):
+    loader = ShardLoader(database)
+    while True:
+        rows = chunks.get()
+        if rows is None:
+            break
+        loader.load(rows)
+        progress.put((database, len(rows), False))
+    loader.finish()
+    progress.put((database, 0, True))
 
-    sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
-    sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
+# Loads the shards in this process, one after another
+class InlineLoaders:
+    def __init__(self, databases):
+        self.loaders = [ShardLoader(database) for database in databases]
+        self.loaded = 0
+
+    def put(self, shard, rows):
+        self.loaders[shard].load(rows)
+        self.loaded += len(rows)
+
+    def finish(self):
+        for loader in self.loaders:
+            loader.finish()
+
+class LoadError(RuntimeError):
+    pass
+
+# One worker process per shard, fed through bounded queues. Queue operations
+# time out every POLL_INTERVAL to check that no worker has died, which would
+# otherwise leave the load waiting forever.
+class ProcessLoaders:
+    def __init__(self, databases):
+        self.databases = databases
+        self.progress = multiprocessing.Queue()
+        self.chunks = [multiprocessing.Queue(maxsize=QUEUE_DEPTH) for _ in databases]
+        self.workers = [
+            multiprocessing.Process(target=load_shard, args=(database, shard_chunks, self.progress))
+            for database, shard_chunks in zip(databases, self.chunks)
+        ]
+        for worker in self.workers:
+            worker.start()
+        self.loaded = 0
+        self.finished = set()
 
-    shard1_connection = sqlite3.connect('./var/games1.db', detect_types=sqlite3.PARSE_DECLTYPES)
-    shard2_connection = sqlite3.connect('./var/games2.db', detect_types=sqlite3.PARSE_DECLTYPES)
-    shard3_connection = sqlite3.connect('./var/games3.db', detect_types=sqlite3.PARSE_DECLTYPES)
+    def put(self, shard, rows):
+        while True:
+            try:
+                self.chunks[shard].put(rows, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                self.check_workers()
+        self.collect()
 
-    for game in game_cur.execute("SELECT * FROM games"):
-        new_user_id = map_key.get(game[0])
+    def collect(self, block=False):
+        while True:
+            try:
+                database, rows, done = self.progress.get(block=block, timeout=POLL_INTERVAL if block else None)
+            except queue.Empty:
+                return
+            self.loaded += rows
+            if done:
+                self.finished.add(database)
+            if block:
+                return
 
-        if int(new_user_id)%3 == 1:
-            insert_to_shard(game, shard1_connection, new_user_id)
+    # A worker that exits before reporting its shard finished has failed
+    def check_workers(self):
+        self.collect()
+        for shard, (database, worker) in enumerate(zip(self.databases, self.workers), 1):
+            if worker.exitcode is not None and database not in self.finished:
+                self.terminate()
+                raise LoadError(f"Loader for shard {shard} ({database}) exited with code {worker.exitcode}")
 
-        elif int(new_user_id)%3 == 2:
-            insert_to_shard(game, shard2_connection, new_user_id)
+    def terminate(self):
+        for shard_chunks in self.chunks:
+            shard_chunks.cancel_join_thread()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
 
-        else:
-            insert_to_shard(game, shard3_connection, new_user_id)
-    shard1_connection.commit()
-    shard1_connection.close()
+    def finish(self):
+        for shard in range(len(self.chunks)):
+            self.put(shard, None)
+        while len(self.finished) < len(self.workers):
+            self.collect(block=True)
+            self.check_workers()
+        for worker in self.workers:
+            worker.join()
 
-    shard2_connection.commit()
-    shard2_connection.close()
+def shard_games(source, map_key, router, chunk_size=CHUNK_SIZE, workers=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        loaders = ProcessLoaders(router.databases)
+    else:
+        loaders = InlineLoaders(router.databases)
 
-    shard3_connection.commit()
-    shard3_connection.close()
+    # Where each user's games go, and their id as stored in the shard
+    placement = {
+        old_user_id: (router.shard_for(new_user_id) - 1, new_user_id.bytes_le)
+        for old_user_id, new_user_id in map_key.items()
+    }
 
+    start = time.perf_counter()
+    read = 0
+    game_connection = sqlite3.connect(source)
+    game_cur = game_connection.execute("SELECT user_id, game_id, finished, guesses, won FROM games")
+    while True:
+        rows = game_cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        parts = [[] for _ in router.databases]
+        for game in rows:
+            shard, new_user_id = placement[game[0]]
+            parts[shard].append((new_user_id, game[1], game[2], game[3], game[4]))
+        for shard, part in enumerate(parts):
+            if part:
+                loaders.put(shard, part)
+
+        read += len(rows)
+        elapsed = time.perf_counter() - start
+        print(f"{read} games read, {loaders.loaded} loaded, {loaders.loaded / elapsed:,.0f} rows/sec")
     game_connection.close()
 
+    print("\nBuilding indexes and user statistics...")
+    loaders.finish()
+
+    elapsed = time.perf_counter() - start
+    print(f"\nSharded {read} games in {elapsed:.2f}s ({read / elapsed:,.0f} rows/sec)\n")
+    return read, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Split stats.db into users.db and the games shards")
+    parser.add_argument('--source', default='./var/stats.db')
+    parser.add_argument('--users', default='./var/users.db')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--workers', type=int,
+                        help="load shards in parallel processes when above 1 (default: number of CPUs)")
+    args = parser.parse_args()
+
+    user_connection = sqlite3.connect(args.source)
+    user_cur = user_connection.cursor()
+    users = user_cur.execute("SELECT * FROM users")
+    map_key = create_user_database(users, args.users)
+    user_connection.close()
+
+    # The services cache users.db lookups, including unknown users
+    try:
+        userdir.publish_invalidation(redis.Redis())
+    except redis.RedisError as e:
+        print(f"Could not notify the services of the new users: {e}\n")
+
+    router = shardrouter.from_env()
+    for database in router.databases:
+        create_sharding_games(database, indexes=False)
+
+    print(f"Sharding games into {len(router.databases)} different games database...\n")
+    shard_games(args.source, map_key, router, args.chunk_size, args.workers)
+
+    # The bloom filters of the old shards no longer match
+    try:
+        bloom.drop(redis.Redis())
+    except redis.RedisError as e:
+        print(f"Could not delete the bloom filters of the old shards, rerun ./bloom.py: {e}\n")
+
 if __name__ == '__main__':
     main()
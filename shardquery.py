@@ -0,0 +1,81 @@
+# Scatter-gather queries across the games shards.
+# A query runs on every shard at once on a shared thread pool, using the
+# pooled connections, and the partial results are merged here: sums and
+# counts add up and averages are recomputed from their sums and counts.
+# Top-k lists are merged from each shard's sorted rows as they are read, so
+# a response can stream the first rows before the last are fetched.
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dbpool
+
+_executor = ThreadPoolExecutor(thread_name_prefix="shardquery")
+
+
+class ShardResult:
+    def __init__(self, shard, database, rows, elapsed):
+        self.shard = shard
+        self.database = database
+        self.rows = rows
+        self.elapsed = elapsed
+
+
+def query_shard(shard, database, sql, params):
+    start = time.perf_counter()
+    with dbpool.connection(database) as db:
+        rows = [tuple(row) for row in db.execute(sql, params)]
+    return ShardResult(shard, database, rows, time.perf_counter() - start)
+
+
+def submit(databases, sql, params):
+    return [
+        _executor.submit(query_shard, shard, database, sql, params)
+        for shard, database in enumerate(databases, start=1)
+    ]
+
+
+# Results from every shard, in shard order
+def scatter(databases, sql, params=()):
+    return [future.result() for future in submit(databases, sql, params)]
+
+
+# Rows of one shard as its cursor produces them, holding a pooled connection
+# until they run out or the iterator is closed
+def iterate(database, sql, params=()):
+    with dbpool.connection(database) as db:
+        for row in db.execute(sql, params):
+            yield tuple(row)
+
+
+# The top k rows overall, merged from every shard's rows sorted descending as
+# they are read, so the first rows can be sent before the last are fetched
+def stream_top(databases, sql, params, k, key):
+    shards = [iterate(database, sql, params) for database in databases]
+    try:
+        yield from itertools.islice(heapq.merge(*shards, key=key, reverse=True), k)
+    finally:
+        for shard in shards:
+            shard.close()
+
+
+# Column-wise sums of single-row aggregates; NULLs from empty shards count as 0
+def merge_sums(results):
+    totals = None
+    for result in results:
+        for row in result.rows:
+            values = [value or 0 for value in row]
+            totals = values if totals is None else [a + b for a, b in zip(totals, values)]
+    return totals or []
+
+
+def merge_average(total, count):
+    return total / count if count else 0
+
+
+def server_timing(results):
+    return ", ".join(
+        f"shard{result.shard};dur={result.elapsed * 1000:.2f}"
+        for result in sorted(results, key=lambda result: result.shard)
+    )
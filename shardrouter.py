@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Maps each user to the games shard that holds their games.
+# Users are placed on a consistent hash ring with virtual nodes per shard, so
+# adding a shard only moves the users that land on its new points instead of
+# reshuffling everyone.
+#
+# Run this file after changing the number of shards to move the users whose
+# games are now on the wrong shard. Each user is moved in their own
+# transaction, so the services can keep running while it works. Games still
+# queued for ./writebehind.py on a shard's stream are first requeued on the
+# stream of the shard the ring now assigns, and each moved user's cached
+# statistics are invalidated. A game a writer was already recording when its
+# entry moved can still land on the old shard; running this again moves it:
+#
+#     SHARD_COUNT=4 ./shardrouter.py [--from-shards 3] [--dry-run]
+import argparse
+import bisect
+import hashlib
+import os
+import sqlite3
+import uuid
+
+import redis
+
+import bloom
+import cache
+import shard
+import userstats
+import writebehind
+
+GAME_DATABASE = './var/games{}.db'
+SHARD_COUNT = 3
+SHARD_VNODES = 160
+
+# Stream entries read per round trip when requeueing games
+REQUEUE_BATCH_SIZE = 500
+
+
+def ring_point(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+class ShardRouter:
+    def __init__(self, databases, vnodes=SHARD_VNODES):
+        self.databases = list(databases)
+        ring = sorted(
+            (ring_point(f'shard{shard}#{vnode}'.encode()), shard)
+            for shard in self.shards
+            for vnode in range(vnodes)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [shard for _, shard in ring]
+
+    @classmethod
+    def from_template(cls, template, count, vnodes=SHARD_VNODES):
+        return cls([template.format(shard) for shard in range(1, count + 1)], vnodes)
+
+    @property
+    def shards(self):
+        return range(1, len(self.databases) + 1)
+
+    def shard_for(self, user_id):
+        if not isinstance(user_id, uuid.UUID):
+            user_id = uuid.UUID(str(user_id))
+        i = bisect.bisect(self._points, ring_point(user_id.bytes)) % len(self._points)
+        return self._owners[i]
+
+    def database_for(self, user_id):
+        return self.databases[self.shard_for(user_id) - 1]
+
+
+# Router for the command line tools, configured with the same variables as
+# the services' settings
+def from_env():
+    return ShardRouter.from_template(
+        os.environ.get('GAME_DATABASE', GAME_DATABASE),
+        int(os.environ.get('SHARD_COUNT', SHARD_COUNT)),
+        int(os.environ.get('SHARD_VNODES', SHARD_VNODES)),
+    )
+
+
+def connect(database):
+    connection = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
+    connection.execute('PRAGMA busy_timeout = 5000')
+    return connection
+
+
+# Copy one user's games to their new shard, rebuild their summary and streaks
+# there and remove them from the old shard, all in one transaction
+def move_user(target, user_id):
+    target.execute('BEGIN')
+    target.execute('INSERT OR IGNORE INTO main.games SELECT * FROM source.games WHERE user_id = ?', [user_id])
+    target.execute('DELETE FROM source.games WHERE user_id = ?', [user_id])
+    target.execute('DELETE FROM source.user_stats WHERE user_id = ?', [user_id])
+    target.execute('DELETE FROM source.streak_runs WHERE user_id = ?', [user_id])
+    userstats.rebuild(target, user_id)
+    target.execute('COMMIT')
+
+
+# Move the games queued on a shard's write-behind stream whose users the
+# router places on another shard to that shard's stream. Entries a writer has
+# read but not acknowledged are moved too, and the writer acknowledges the
+# deleted entries without writing them when it reads them again.
+def requeue(client_redis, router, shard_num):
+    key = writebehind.stream_key(shard_num)
+    requeued = 0
+    start = "-"
+    while True:
+        entries = client_redis.xrange(key, start, "+", count=REQUEUE_BATCH_SIZE)
+        misplaced = []
+        for entry_id, fields in entries:
+            try:
+                target = router.shard_for(fields[b"user_id"].decode('utf-8'))
+            except (KeyError, ValueError):
+                continue
+            if target != shard_num:
+                misplaced.append((entry_id, fields, target))
+        if misplaced:
+            pipe = client_redis.pipeline(transaction=True)
+            for _, fields, target in misplaced:
+                pipe.xadd(writebehind.stream_key(target), fields)
+            pipe.xdel(key, *[entry_id for entry_id, _, _ in misplaced])
+            pipe.execute()
+            requeued += len(misplaced)
+        if len(entries) < REQUEUE_BATCH_SIZE:
+            return requeued
+        start = b"(" + entries[-1][0]
+
+
+# sources maps each existing shard number to its database. With a Redis
+# client, games queued for the wrong shard are requeued first, a user's games
+# are added to the bloom filter of their new shard before they move there and
+# their cached statistics are invalidated once they have.
+def rebalance(router, sources, dry_run=False, client_redis=None):
+    bloom_filters = bloom.from_env(client_redis, router) if client_redis else None
+    stats_cache = cache.ResponseCache(client_redis, "stats:users") if client_redis else None
+    moved = {}
+    for shard_num, source in sources.items():
+        if client_redis and not dry_run:
+            requeued = requeue(client_redis, router, shard_num)
+            if requeued:
+                print(f"{writebehind.stream_key(shard_num)}: {requeued} queued games requeued")
+
+        connection = connect(source)
+        users = [row[0] for row in connection.execute('SELECT DISTINCT user_id FROM games')]
+        connection.close()
+
+        misplaced = {}
+        for user_id in users:
+            target = router.shard_for(user_id)
+            if target != shard_num:
+                misplaced.setdefault(target, []).append(user_id)
+
+        for target, user_ids in misplaced.items():
+            print(f"{source}: {len(user_ids)} users move to {router.databases[target - 1]}")
+            moved[(shard_num, target)] = len(user_ids)
+            if dry_run:
+                continue
+            if not os.path.exists(router.databases[target - 1]):
+                shard.create_sharding_games(router.databases[target - 1])
+            connection = connect(router.databases[target - 1])
+            connection.isolation_level = None
+            userstats.create_table(connection)
+            connection.execute('ATTACH DATABASE ? AS source', [source])
+            for user_id in user_ids:
+                if bloom_filters:
+                    games = connection.execute('SELECT game_id FROM source.games WHERE user_id = ?', [user_id])
+                    bloom_filters[target].add([(user_id, game_id) for game_id, in games])
+                move_user(connection, user_id)
+                if stats_cache:
+                    stats_cache.invalidate(str(user_id))
+            connection.close()
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move users onto the shards the ring assigns them")
+    parser.add_argument('--from-shards', type=int,
+                        help="number of shards before the change, if shards are being removed")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would move")
+    args = parser.parse_args()
+
+    router = from_env()
+    template = os.environ.get('GAME_DATABASE', GAME_DATABASE)
+    count = max(len(router.databases), args.from_shards or 0)
+    sources = {
+        shard_num: template.format(shard_num)
+        for shard_num in range(1, count + 1)
+        if os.path.exists(template.format(shard_num))
+    }
+
+    client_redis = None
+    if not args.dry_run:
+        client_redis = redis.Redis()
+        try:
+            client_redis.ping()
+        except redis.RedisError as e:
+            print(f"Could not reach Redis to requeue games, update the bloom filters and invalidate cached "
+                  f"statistics. Rerun ./shardrouter.py and ./bloom.py once it is back: {e}")
+            client_redis = None
+
+    moved = rebalance(router, sources, args.dry_run, client_redis)
+    print(f"{sum(moved.values())} users {'to move' if args.dry_run else 'moved'}")
+
+if __name__ == '__main__':
+    main()
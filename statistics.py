@@ -1,25 +1,60 @@
-import contextlib
 import logging.config
 import sqlite3
 import uuid
 import datetime
+import json
 import redis
+from typing import Optional
 
 
-from fastapi import FastAPI, Depends, HTTPException, status
-from pydantic import BaseModel, BaseSettings
+from fastapi import FastAPI, HTTPException, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, BaseSettings, ValidationError
 
-sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
-sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
+import bloom
+import cache
+import dbpool
+import instrument
+import leaderboards
+import replicate
+import shardquery
+import shardrouter
+import userdir
+import userstats
 
 class Settings(BaseSettings):
     stat_database: str
     logging_config: str
     
     user_database: str
-    game1_database: str
-    game2_database: str
-    game3_database: str
+    # Games shards are game_database formatted with the shard number
+    game_database: str = "./var/games{}.db"
+    shard_count: int = 3
+    shard_vnodes: int = 160
+
+    pool_size: int = 5
+    pool_timeout: float = 5.0
+
+    # Read from the replicas kept by ./replicate.py while they are at most
+    # replica_max_staleness seconds old; empty to read from the shards
+    replica_database: str = ""
+    replica_max_staleness: float = 5.0
+
+    # Bloom filters of the games in each shard, sized for bloom_capacity
+    # games per shard; see bloom.py
+    bloom_capacity: int = bloom.CAPACITY
+    bloom_error_rate: float = bloom.ERROR_RATE
+
+    # /users/{user_id} responses, kept in Redis and in each process
+    stats_cache_size: int = 10000
+    stats_cache_ttl: int = 3600
+    stats_cache_local_ttl: float = 30.0
+
+    # Cached users.db lookups; unknown users are cached for user_negative_ttl
+    user_cache_size: int = 100000
+    user_cache_ttl: float = 3600.0
+    user_negative_ttl: float = 60.0
 
     class Config:
         env_file = ".env"
@@ -31,54 +66,88 @@ class Game(BaseModel):
     guesses: int
     won: bool
 
-# Get different databases
-def get_user_db():
-    with contextlib.closing(sqlite3.connect(settings.user_database, detect_types=sqlite3.PARSE_DECLTYPES)) as db:
-        db.row_factory = sqlite3.Row
-        yield db
-
-def get_game1_db():
-    with contextlib.closing(sqlite3.connect(settings.game1_database, detect_types=sqlite3.PARSE_DECLTYPES)) as db:
-        db.row_factory = sqlite3.Row
-        yield db
-
-def get_game2_db():
-    with contextlib.closing(sqlite3.connect(settings.game2_database, detect_types=sqlite3.PARSE_DECLTYPES)) as db:
-        db.row_factory = sqlite3.Row
-        yield db
-
-def get_game3_db():
-    with contextlib.closing(sqlite3.connect(settings.game3_database, detect_types=sqlite3.PARSE_DECLTYPES)) as db:
-        db.row_factory = sqlite3.Row
-        yield db
-
 def get_logger():
     return logging.getLogger(__name__)
 
 
 settings = Settings()
 app = FastAPI(root_path="/stats")
-client_redis = redis.Redis()
+instrument.instrument(app)
+client_redis = instrument.instrument_redis(redis.Redis())
+dbpool.configure(size=settings.pool_size, timeout=settings.pool_timeout)
+router = shardrouter.ShardRouter.from_template(settings.game_database, settings.shard_count, settings.shard_vnodes)
+readers = replicate.ReplicaSet(router, settings.replica_database, settings.replica_max_staleness)
+bloom_filters = bloom.filters(client_redis, router, settings.bloom_capacity, settings.bloom_error_rate)
+
+page_script = client_redis.register_script(leaderboards.PAGE_SCRIPT)
+around_script = client_redis.register_script(leaderboards.AROUND_SCRIPT)
+
+stats_cache = cache.ResponseCache(
+    client_redis, "stats:users",
+    settings.stats_cache_size, settings.stats_cache_ttl, settings.stats_cache_local_ttl,
+)
+users = userdir.UserDirectory(
+    settings.user_database, client_redis,
+    settings.user_cache_size, settings.user_cache_ttl, settings.user_negative_ttl,
+)
+
+instrument.configure_logging(settings.logging_config)
+
+@app.on_event("startup")
+def start_cache():
+    stats_cache.start()
+    users.start()
+
+@app.on_event("shutdown")
+def close_pools():
+    stats_cache.stop()
+    users.stop()
+    dbpool.close_all()
+
+# Drop cached statistics once new games are committed; entries that cannot
+# be invalidated expire after stats_cache_ttl
+def invalidate_stats(*user_ids):
+    try:
+        stats_cache.invalidate(*(str(user_id) for user_id in user_ids))
+    except redis.RedisError:
+        get_logger().exception("Could not invalidate cached statistics for %d users", len(user_ids))
+
+# Add committed games to their shard's bloom filter, which trackgamestate
+# trusts when it says a game was not played. If they cannot be added the
+# filter, and any being built, is deleted, so start_game reads the shard
+# until it is rebuilt.
+def add_to_bloom(shard, pairs):
+    bloom_filter = bloom_filters[shard]
+    try:
+        bloom_filter.add(pairs)
+    except redis.RedisError:
+        get_logger().exception("Could not add %d games to the bloom filter of shard %d", len(pairs), shard)
+        try:
+            bloom_filter.client_redis.delete(bloom_filter.key, bloom_filter.staging)
+        except redis.RedisError:
+            get_logger().error("Could not delete the bloom filter of shard %d; rerun ./bloom.py", shard)
 
-logging.config.fileConfig(settings.logging_config)
+# Connection pool checkouts and acquire waits
+@app.get("/pool")
+def pool_stats():
+    return {"pools": dbpool.stats()}
+
+# Reads served by the replicas and the shards, and the age of each replica
+@app.get("/replicas")
+def replica_stats():
+    return readers.stats()
 
 
 # Post a new games
 @app.post("/games/", status_code=status.HTTP_201_CREATED)
-def insert_new_game(
-    game: Game,
-    user_db: sqlite3.Connection = Depends(get_user_db),
-    game1_db: sqlite3.Connection = Depends(get_game1_db),
-    game2_db: sqlite3.Connection = Depends(get_game2_db),
-    game3_db: sqlite3.Connection = Depends(get_game3_db),
-):
-    print("<= request routed to this instance\n")
+def insert_new_game(game: Game):
+    get_logger().debug("Request routed to this instance")
     g = dict(game)
     user_id = uuid.UUID(g['user_id'])
 
     # Check whether user_id exists in the user database or not
-    player = user_db.execute("SELECT * FROM users WHERE user_id = ?", [user_id]).fetchall()
-    if not player:
+    username = users.username(user_id)
+    if username is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Player not found"
         )
@@ -89,113 +158,216 @@ def insert_new_game(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid number of guesses"
         )
 
-    # Choose the correct shard to insert a new game
-    if int(user_id) % 3 == 1:
-        db = game1_db
-    elif int(user_id) % 3 == 2:
-        db = game2_db
-    else:
-        db = game3_db
-
     # Make sure user_id is UUID in game class before inserting in games 
     g["user_id"]= user_id
+
+    # Insert the new game into the user's shard and update their summary
+    with dbpool.connection(router.database_for(user_id)) as db:
+        try:
+            stats = userstats.record_game(db, g)
+            db.commit()
+        except sqlite3.IntegrityError as e:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail={"type": type(e).__name__, "msg": str(e)},
+            )
+    add_to_bloom(router.shard_for(user_id), [(user_id, g["game_id"])])
+    invalidate_stats(user_id)
+
+    # Update the leaderboards right away; ./leaderboards.py repairs them
+    # if this fails
     try:
-        db.execute(
-            """
-            INSERT INTO games(user_id, game_id, finished, guesses, won) 
-            VALUES(:user_id, :game_id, :finished, :guesses, :won)
-            """,
-            g
-        )
-        db.commit()
-    except sqlite3.IntegrityError as e:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail={"type": type(e).__name__, "msg": str(e)},
-        )
+        leaderboards.update_player(client_redis, username, stats, won_on=g["finished"] if g["won"] else None)
+    except redis.RedisError:
+        get_logger().exception("Could not update leaderboards for %s", user_id)
+    return g
+
+# Post many games at once, as a JSON array or as NDJSON (one game per line
+# with Content-Type: application/x-ndjson). Users are looked up in batches
+# and each shard's games are inserted in a single transaction. Every game gets
+# its own status, in the order posted, with the same codes as /games/.
+@app.post("/games/bulk")
+async def insert_games_bulk(request: Request):
+    get_logger().debug("Request routed to this instance")
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        rows = [line for line in body.splitlines() if line.strip()]
+    else:
+        try:
+            rows = json.loads(body)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid JSON: {e}"
+            )
+        if not isinstance(rows, list):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Expected an array of games"
+            )
+    return await run_in_threadpool(insert_games, rows)
+
+def parse_game(row):
+    if isinstance(row, bytes):
+        row = json.loads(row)
+    g = dict(Game.parse_obj(row))
+    g["user_id"] = uuid.UUID(g["user_id"])
     return g
 
-# Get stat of a user based on user_id
+def insert_games(rows):
+    results = [None] * len(rows)
+    games = {}
+    for i, row in enumerate(rows):
+        try:
+            games[i] = parse_game(row)
+        except (ValueError, ValidationError) as e:
+            results[i] = {"status": status.HTTP_422_UNPROCESSABLE_ENTITY, "detail": str(e)}
+
+    usernames = users.usernames({g["user_id"] for g in games.values()})
+
+    by_shard = {}
+    for i, g in games.items():
+        if g["user_id"] not in usernames:
+            results[i] = {"status": status.HTTP_404_NOT_FOUND, "detail": "Player not found"}
+        elif g["guesses"] < 1 or g["guesses"] > 6:
+            results[i] = {"status": status.HTTP_400_BAD_REQUEST, "detail": "Invalid number of guesses"}
+        else:
+            by_shard.setdefault(router.shard_for(g["user_id"]), []).append(i)
+
+    # Games are inserted in date order, so imported history extends streaks
+    # instead of rebuilding them. A failed insert leaves the shard's
+    # transaction as it was, so only that game is rejected.
+    players = {}
+    wins = []
+    recorded = set()
+    for shard, indexes in by_shard.items():
+        indexes.sort(key=lambda i: games[i]["finished"])
+        with dbpool.connection(router.databases[shard - 1]) as db:
+            for i in indexes:
+                g = games[i]
+                try:
+                    players[usernames[g["user_id"]]] = userstats.record_game(db, g)
+                    recorded.add(g["user_id"])
+                    if g["won"]:
+                        wins.append((usernames[g["user_id"]], g["finished"]))
+                    results[i] = {"status": status.HTTP_201_CREATED}
+                except sqlite3.IntegrityError as e:
+                    results[i] = {
+                        "status": status.HTTP_409_CONFLICT,
+                        "detail": {"type": type(e).__name__, "msg": str(e)},
+                    }
+            db.commit()
+        add_to_bloom(shard, [
+            (games[i]["user_id"], games[i]["game_id"]) for i in indexes
+            if results[i]["status"] == status.HTTP_201_CREATED
+        ])
+
+    if recorded:
+        invalidate_stats(*recorded)
+    if players:
+        try:
+            leaderboards.update_players(client_redis, players, wins)
+        except redis.RedisError:
+            get_logger().exception("Could not update leaderboards for %d players", len(players))
+
+    created = sum(result["status"] == status.HTTP_201_CREATED for result in results)
+    return {
+        "created": created,
+        "failed": len(results) - created,
+        "results": [dict(result, index=i) for i, result in enumerate(results)],
+    }
+
+# Get stat of a user based on user_id. Responses are served from the cache
+# and carry an ETag, so a client polling with If-None-Match gets a 304 until
+# the user finishes another game.
 @app.get("/users/{user_id}")
-def retrieve_stat(
-    user_id: str,
-    user_db: sqlite3.Connection = Depends(get_user_db),
-    game1_db: sqlite3.Connection = Depends(get_game1_db),
-    game2_db: sqlite3.Connection = Depends(get_game2_db),
-    game3_db: sqlite3.Connection = Depends(get_game3_db)
-):
-    print("<= request routed to this instance\n")
+def retrieve_stat(user_id: str, request: Request):
+    get_logger().debug("Request routed to this instance")
     user_id = uuid.UUID(user_id)
 
-    # Check whether user_id exists in the user database or not
-    player = user_db.execute("SELECT * FROM users WHERE user_id = ?",[user_id]).fetchall()
-    if not player:
+    def compute():
+        # Check whether user_id exists in the user database or not
+        if users.username(user_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Player not found"
+            )
+
+        # All statistics come from the user's summary row, on a replica
+        # only if it was taken after the user's last game was recorded
+        with dbpool.connection(readers.database_for(user_id, stats_cache.invalidated_at(str(user_id)))) as db:
+            return json.dumps(userstats.to_response(userstats.get(db, user_id)))
+
+    body, etag = stats_cache.get(str(user_id), compute)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [tag.strip().replace("W/", "", 1) for tag in request.headers.get("if-none-match", "").split(",")]:
+        stats_cache.count("not_modified")
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+# Hits and misses of the /users/{user_id} cache and the user directory
+@app.get("/cache")
+def cache_stats():
+    return {"users": stats_cache.stats(), "directory": users.stats()}
+
+############################################### Global statistics ###############################################
+
+# Aggregates over every shard, gathered concurrently. Per-shard query times
+# are returned in the Server-Timing header.
+
+@app.get("/global")
+def global_stats(response: Response):
+    results = shardquery.scatter(
+        readers.databases,
+        "SELECT COUNT(*), SUM(played), SUM(won), SUM(guess_total) FROM user_stats"
+    )
+    players, played, won, guess_total = shardquery.merge_sums(results)
+    response.headers["Server-Timing"] = shardquery.server_timing(results)
+
+    return {
+        "players": players,
+        "gamesPlayed": played,
+        "gamesWon": won,
+        "winPercentage": round(shardquery.merge_average(won, played) * 100),
+        "averageGuesses": round(shardquery.merge_average(guess_total, played), 2),
+    }
+
+@app.get("/global/guesses")
+def global_guesses(response: Response):
+    results = shardquery.scatter(
+        readers.databases,
+        "SELECT SUM(guess1), SUM(guess2), SUM(guess3), SUM(guess4), SUM(guess5), SUM(guess6), SUM(fail) FROM user_stats"
+    )
+    totals = shardquery.merge_sums(results)
+    response.headers["Server-Timing"] = shardquery.server_timing(results)
+
+    guess_record = {f'{n}': totals[n - 1] for n in range(1, 7)}
+    guess_record["fail"] = totals[6]
+    return {"guesses": guess_record}
+
+# Top k users across all shards, streamed back as NDJSON
+@app.get("/global/top/{board}")
+def global_top(board: str, k: int = 10):
+    if k < 1 or k > 100:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Player not found"
+            status_code=status.HTTP_400_BAD_REQUEST, detail="k must be between 1 and 100"
+        )
+    columns = {"wins": "won", "streaks": "max_streak"}
+    if board not in columns:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Leaderboard not found"
         )
 
-    # Choose the correct shard for this user_id
-    if int(user_id) % 3 == 1:
-        db = game1_db
-    elif int(user_id) % 3 == 2:
-        db = game2_db
-    else:
-        db = game3_db
-
-    currentStreak = maxStreak = gamesPlayed = gamesWon = averageGuesses = fail = winPercentage = 0
-    statistics = {}
-
-    # Get current streak
-    streak1 = db.execute("SELECT streak FROM streaks WHERE user_id = ? ORDER BY ending DESC", [user_id]).fetchone()
-    if streak1:
-        currentStreak = streak1[0]
-
-    # Get max streak
-    streak2 = db.execute("SELECT streak FROM streaks WHERE user_id = ? ORDER BY streak DESC LIMIT 1", [user_id]).fetchone()
-    if streak2:
-        maxStreak = streak2[0]
-
-    # Get total games played
-    games = db.execute("SELECT COUNT(user_id) FROM games WHERE user_id = ?", [user_id]).fetchone()
-    if games:
-        gamesPlayed = games[0]
-
-    # Get total games won
-    wins = db.execute("SELECT COUNT(user_id) FROM games WHERE user_id = ? AND won = 1", [user_id]).fetchone()
-    if wins:
-        gamesWon = wins[0]
-
-    # Get average guesses
-    avgGuess = db.execute("SELECT AVG(guesses) FROM games WHERE user_id = ?", [user_id]).fetchone()
-    if avgGuess:
-        averageGuesses = round(avgGuess[0])
-
-    # Calculate win %
-    if gamesPlayed != 0:
-        winPercentage = round((gamesWon/gamesPlayed)*100)
-
-    # Get guesses counts
-    guessCount = db.execute("SELECT guesses, COUNT(guesses) FROM games WHERE user_id = ? and won !=0 GROUP BY guesses", [user_id]).fetchall()
-
-    guess_record = {'1':0, '2':0, '3':0,'4':0, '5':0, '6':0, 'fail':0}
-    for guess in guessCount:
-        guess_record[f'{guess[0]}'] = guess[1]
-
-    # Get number of games failed
-    gamesFailed = db.execute("SELECT count(won) FROM games WHERE user_id = ? AND won = 0", [user_id]).fetchone()
-    if gamesFailed:
-        fail = gamesFailed[0]
-    guess_record["fail"] = fail
-
-    statistics["currentStreak"] = currentStreak
-    statistics["maxStreak"] = maxStreak
-    statistics["guesses"] = guess_record
-    statistics["winPercentage"] = winPercentage
-    statistics["gamesPlayed"] = gamesPlayed
-    statistics["gamesWon"] = gamesWon
-    statistics["averageGuesses"] = averageGuesses
-
-    return statistics
+    # Lines are sent as each shard's rows are merged, without waiting for
+    # the whole top k
+    top = shardquery.stream_top(
+        readers.databases,
+        f"SELECT user_id, {columns[board]} FROM user_stats ORDER BY {columns[board]} DESC LIMIT ?",
+        [k], k, key=lambda row: row[1],
+    )
+
+    def rows():
+        for user_id, value in top:
+            yield json.dumps({"user_id": str(user_id), board: value}) + "\n"
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
 
 ################################################### Leaderboard #################################################
 
@@ -222,3 +394,71 @@ def list_ten_wins():
         top_ten_wins.append({"username" : username, "wins" : wins})
     
     return {"top_ten_wins" : top_ten_wins}
+
+# Every ranked player, a page at a time. Pass next_cursor back as cursor for
+# the following page. The wins board can also be read over the daily or the
+# weekly window ending on date (today by default).
+def get_board_key(board, window, date):
+    if board not in leaderboards.BOARDS:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Leaderboard not found"
+        )
+    if window not in leaderboards.WINDOWS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Window must be one of {', '.join(leaderboards.WINDOWS)}"
+        )
+    if window != "all" and board != "wins":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Only the wins board has daily and weekly windows"
+        )
+    return leaderboards.board_key(client_redis, board, window, date)
+
+@app.get("/leaders/{board}")
+def list_leaders(
+    board: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    window: str = "all",
+    date: Optional[datetime.date] = None,
+):
+    if limit < 1 or limit > 100:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Limit must be between 1 and 100"
+        )
+    key = get_board_key(board, window, date)
+    try:
+        entries, next_cursor = leaderboards.page(page_script, key, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+    return {"board": board, "window": window, "entries": entries, "next_cursor": next_cursor}
+
+# A player's rank on a board with up to neighbors players either side
+@app.get("/leaders/{board}/users/{username}")
+def player_rank(
+    board: str,
+    username: str,
+    neighbors: int = 5,
+    window: str = "all",
+    date: Optional[datetime.date] = None,
+):
+    if neighbors < 0 or neighbors > 50:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Neighbors must be between 0 and 50"
+        )
+    key = get_board_key(board, window, date)
+    entries = leaderboards.around(around_script, key, username, neighbors)
+    if entries is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Player not ranked"
+        )
+    player = next(entry for entry in entries if entry["username"] == username)
+    return {
+        "board": board,
+        "window": window,
+        "rank": player["rank"],
+        "score": player["score"],
+        "above": [entry for entry in entries if entry["rank"] < player["rank"]],
+        "below": [entry for entry in entries if entry["rank"] > player["rank"]],
+    }
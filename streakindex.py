@@ -0,0 +1,98 @@
+# Persisted index of winning streaks, kept in each games shard.
+# Every run of consecutive days with a win is one row of streak_runs. A new win
+# either extends the user's latest run or starts a new one, so recording a game
+# touches one row, and a user's current and longest streaks and the longest
+# streaks overall are index seeks instead of evaluations of the streaks view.
+#
+# As in the view, a streak is a run longer than one day.
+import datetime
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS streak_runs(
+    user_id GUID NOT NULL,
+    beginning DATE NOT NULL,
+    ending DATE NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY(user_id, beginning)
+);
+CREATE INDEX IF NOT EXISTS streak_runs_length_idx ON streak_runs(length);
+CREATE INDEX IF NOT EXISTS streak_runs_user_ending_idx ON streak_runs(user_id, ending);
+CREATE INDEX IF NOT EXISTS streak_runs_user_length_idx ON streak_runs(user_id, length);
+'''
+
+
+def create_table(db):
+    db.executescript(SCHEMA)
+
+
+# Record a win. Returns the length of the run it belongs to, which is the
+# user's latest run, or None when the win predates the latest run and the
+# user's runs had to be rebuilt.
+def add_win(db, user_id, finished):
+    latest = db.execute(
+        "SELECT beginning, ending, length FROM streak_runs WHERE user_id = ? ORDER BY ending DESC LIMIT 1",
+        [user_id]
+    ).fetchone()
+
+    if latest is None or finished > latest[1] + datetime.timedelta(days=1):
+        db.execute(
+            "INSERT INTO streak_runs(user_id, beginning, ending, length) VALUES(?, ?, ?, 1)",
+            [user_id, finished, finished]
+        )
+        return 1
+    if finished == latest[1]:
+        return latest[2]
+    if finished == latest[1] + datetime.timedelta(days=1):
+        db.execute(
+            "UPDATE streak_runs SET ending = ?, length = length + 1 WHERE user_id = ? AND beginning = ?",
+            [finished, user_id, latest[0]]
+        )
+        return latest[2] + 1
+
+    rebuild(db, user_id)
+    return None
+
+
+# Rebuild the runs of one user, or of every user in the shard, from their wins
+def rebuild(db, user_id=None):
+    where, params = ("AND user_id = ?", [user_id]) if user_id is not None else ("", [])
+    db.execute(f"DELETE FROM streak_runs WHERE 1 {where}", params)
+    db.execute(
+        f"""
+        INSERT INTO streak_runs(user_id, beginning, ending, length)
+        SELECT user_id, MIN(finished), MAX(finished), COUNT(*)
+        FROM (
+            SELECT
+                user_id,
+                finished,
+                julianday(finished) - ROW_NUMBER() OVER(PARTITION BY user_id ORDER BY finished) AS island
+            FROM (SELECT DISTINCT user_id, finished FROM games WHERE won != 0 {where})
+        )
+        GROUP BY user_id, island
+        """,
+        params
+    )
+
+
+def current_streak(db, user_id):
+    row = db.execute(
+        "SELECT length FROM streak_runs WHERE user_id = ? AND length > 1 ORDER BY ending DESC LIMIT 1",
+        [user_id]
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def max_streak(db, user_id):
+    row = db.execute(
+        "SELECT MAX(length) FROM streak_runs WHERE user_id = ? AND length > 1",
+        [user_id]
+    ).fetchone()
+    return row[0] or 0
+
+
+# The longest streaks in the shard, as (user_id, length, beginning, ending)
+def top_streaks(db, limit=10):
+    return db.execute(
+        "SELECT user_id, length, beginning, ending FROM streak_runs WHERE length > 1 ORDER BY length DESC LIMIT ?",
+        [limit]
+    ).fetchall()
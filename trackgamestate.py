@@ -1,108 +1,329 @@
-import contextlib
+import datetime
 import logging.config
-import sqlite3
+import time
 import uuid
 import redis
-import json
 
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, HTTPException, status
 from pydantic import BaseModel, BaseSettings
 
-sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
-sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
+import bloom
+import dbpool
+import gamecodec
+import instrument
+import shardrouter
+import replicate
+import userdir
+import writebehind
 
 class Settings(BaseSettings):
     stat_database: str
     logging_config: str
 
     user_database: str
-    game1_database: str
-    game2_database: str
-    game3_database: str
+    # Games shards are game_database formatted with the shard number
+    game_database: str = "./var/games{}.db"
+    shard_count: int = 3
+    shard_vnodes: int = 160
 
-    class Config:
-        env_file = ".env"
+    pool_size: int = 5
+    pool_timeout: float = 5.0
 
-def get_user_db():
-    with contextlib.closing(sqlite3.connect(settings.user_database, detect_types=sqlite3.PARSE_DECLTYPES)) as db:
-        db.row_factory = sqlite3.Row
-        yield db
+    # Read from the replicas kept by ./replicate.py while they are at most
+    # replica_max_staleness seconds old; empty to read from the shards
+    replica_database: str = ""
+    replica_max_staleness: float = 5.0
 
-def get_game1_db():
-    with contextlib.closing(sqlite3.connect(settings.game1_database, detect_types=sqlite3.PARSE_DECLTYPES)) as db:
-        db.row_factory = sqlite3.Row
-        yield db
+    # Bloom filters of the games in each shard, sized for bloom_capacity
+    # games per shard; see bloom.py
+    bloom_capacity: int = bloom.CAPACITY
+    bloom_error_rate: float = bloom.ERROR_RATE
 
-def get_game2_db():
-    with contextlib.closing(sqlite3.connect(settings.game2_database, detect_types=sqlite3.PARSE_DECLTYPES)) as db:
-        db.row_factory = sqlite3.Row
-        yield db
+    # Games not finished within this many seconds expire from redis
+    game_ttl: int = 172800
+    # Finished games are refused while a shard's write-behind stream holds
+    # this many, until ./writebehind.py catches up
+    writebehind_max_backlog: int = 100000
 
-def get_game3_db():
-    with contextlib.closing(sqlite3.connect(settings.game3_database, detect_types=sqlite3.PARSE_DECLTYPES)) as db:
-        db.row_factory = sqlite3.Row
-        yield db
+    # Cached users.db lookups; unknown users are cached for user_negative_ttl
+    user_cache_size: int = 100000
+    user_cache_ttl: float = 3600.0
+    user_negative_ttl: float = 60.0
+
+    class Config:
+        env_file = ".env"
 
 def get_logger():
     return logging.getLogger(__name__)
 
-client_redis = redis.Redis()
+client_redis = instrument.instrument_redis(redis.Redis())
 settings = Settings()
 app = FastAPI(root_path="/games")
+instrument.instrument(app)
+dbpool.configure(size=settings.pool_size, timeout=settings.pool_timeout)
+router = shardrouter.ShardRouter.from_template(settings.game_database, settings.shard_count, settings.shard_vnodes)
+readers = replicate.ReplicaSet(router, settings.replica_database, settings.replica_max_staleness)
+bloom_filters = bloom.filters(client_redis, router, settings.bloom_capacity, settings.bloom_error_rate)
+users = userdir.UserDirectory(
+    settings.user_database, client_redis,
+    settings.user_cache_size, settings.user_cache_ttl, settings.user_negative_ttl,
+)
+
+instrument.configure_logging(settings.logging_config)
+
+@app.on_event("startup")
+def start_user_directory():
+    users.start()
+
+@app.on_event("shutdown")
+def close_pools():
+    users.stop()
+    dbpool.close_all()
+
+# Missing filters are built in the background at startup, and again when a
+# check finds one missing, at most every BLOOM_RETRY_INTERVAL seconds
+BLOOM_RETRY_INTERVAL = 30.0
+bloom_builder = None
+bloom_attempted = 0.0
+
+@app.on_event("startup")
+def build_bloom_filters():
+    global bloom_builder, bloom_attempted
+    if bloom_builder is not None and bloom_builder.is_alive():
+        return
+    bloom_attempted = time.monotonic()
+    bloom_builder = bloom.ensure_all_in_background(bloom_filters, router, get_logger())
+
+# What each shard's filter answered for start_game. A negative saves the
+# shard query; a positive is checked against the shard, which tells true
+# positives from false ones.
+BLOOM_RESULTS = ("negative", "true_positive", "false_positive", "unavailable")
+bloom_checks = instrument.Counter(
+    "bloom_checks_total", "Already-played checks by the bloom filter's answer", ("shard", "result")
+)
+
+@app.get("/bloom")
+def bloom_stats():
+    shards = {}
+    for shard, bloom_filter in bloom_filters.items():
+        checks = {result: bloom_checks.value(str(shard), result) for result in BLOOM_RESULTS}
+        # Share of the games not yet played that the filter still sent to
+        # the shard
+        unplayed = checks["negative"] + checks["false_positive"]
+        stats = {
+            "bits": bloom_filter.bits,
+            "hashes": bloom_filter.hashes,
+            "ready": bloom_filter.exists(),
+            "checks": checks,
+            "queries_saved": checks["negative"],
+            "false_positive_rate": round(checks["false_positive"] / unplayed, 5) if unplayed else None,
+        }
+        if stats["ready"]:
+            ratio, error_rate = bloom_filter.fill()
+            stats["fill_ratio"] = round(ratio, 5)
+            stats["expected_false_positive_rate"] = round(error_rate, 5)
+        shards[shard] = stats
+    return {"capacity": settings.bloom_capacity, "error_rate": settings.bloom_error_rate, "shards": shards}
+
+# True if the user may have played the game. Only then is the shard read.
+def may_have_played(user_id, game_id):
+    shard = router.shard_for(user_id)
+    maybe = bloom_filters[shard].might_contain(user_id, game_id)
+    if maybe is None:
+        bloom_checks.inc(str(shard), "unavailable")
+        if time.monotonic() - bloom_attempted > BLOOM_RETRY_INTERVAL:
+            build_bloom_filters()
+    elif not maybe:
+        bloom_checks.inc(str(shard), "negative")
+        return False
+
+    with dbpool.connection(readers.database_for(user_id)) as db:
+        game = db.execute("SELECT 1 FROM games WHERE user_id = ? AND game_id = ?", [user_id, game_id]).fetchall()
+    if maybe:
+        bloom_checks.inc(str(shard), "true_positive" if game else "false_positive")
+    return bool(game)
+
+# Hits and misses of the user directory
+@app.get("/cache")
+def cache_stats():
+    return {"directory": users.stats()}
 
-logging.config.fileConfig(settings.logging_config)
+# Connection pool checkouts and acquire waits
+@app.get("/pool")
+def pool_stats():
+    return {"pools": dbpool.stats()}
+
+# Games waiting for ./writebehind.py in each shard's stream
+@app.get("/writebehind")
+def writebehind_stats():
+    return {
+        "shards": {
+            shard: {"backlog": length, "oldest_seconds": round(age, 3)}
+            for shard, (length, age) in writebehind.backlog(client_redis, router.shards).items()
+        },
+        "max_backlog": settings.writebehind_max_backlog,
+    }
+
+def collect_backlog():
+    return {(str(shard),): length for shard, (length, _) in writebehind.backlog(client_redis, router.shards).items()}
+
+def collect_oldest():
+    return {(str(shard),): age for shard, (_, age) in writebehind.backlog(client_redis, router.shards).items()}
+
+instrument.Gauge("writebehind_backlog", "Finished games waiting to be written to each shard", ("shard",), collect_backlog)
+instrument.Gauge("writebehind_oldest_seconds", "Age of the oldest game waiting for each shard", ("shard",), collect_oldest)
+
+# Each game in progress is a redis string packed by gamecodec.py. The scripts
+# return -3 for games saved by older versions as JSON strings or hashes,
+# which are converted by migrate_game and the script run again.
+GAME_NOT_FOUND = -1
+GUESS_LIMIT = -2
+LEGACY_GAME = -3
+BACKLOG_FULL = -4
+NO_GUESSES = -5
+
+CHECK_PACKED_GAME = f"""
+local kind = redis.call('TYPE', KEYS[1]).ok
+if kind == 'none' then
+    return {GAME_NOT_FOUND}
+end
+if kind ~= 'string' or redis.call('STRLEN', KEYS[1]) ~= {gamecodec.SIZE}
+        or redis.call('GETRANGE', KEYS[1], 0, 0) ~= string.char({gamecodec.VERSION}) then
+    return {LEGACY_GAME}
+end
+"""
+
+# ARGV: ttl, guess. Checks and spends a remaining guess atomically, writing
+# only the guess slot and the remaining count.
+update_script = client_redis.register_script(CHECK_PACKED_GAME + f"""
+local remain = string.byte(redis.call('GETRANGE', KEYS[1], {gamecodec.REMAIN_OFFSET}, {gamecodec.REMAIN_OFFSET}))
+if remain < 1 then
+    return {GUESS_LIMIT}
+end
+local slot = {gamecodec.GUESSES} - remain
+redis.call('SETRANGE', KEYS[1], {gamecodec.SLOTS_OFFSET} + slot * {gamecodec.SLOT_SIZE}, ARGV[2])
+redis.call('SETRANGE', KEYS[1], {gamecodec.REMAIN_OFFSET}, string.char(remain - 1))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('GET', KEYS[1])
+""")
+
+restore_script = client_redis.register_script(CHECK_PACKED_GAME + """
+return redis.call('GET', KEYS[1])
+""")
+
+# KEYS: game, finished marker, shard stream. ARGV: ttl, max backlog, user_id,
+# game_id, finished date, won. Ends the game and queues it for the shard
+# once; calling it again for the same game returns the game unchanged.
+finish_script = client_redis.register_script(CHECK_PACKED_GAME + f"""
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.call('GET', KEYS[1])
+end
+if redis.call('XLEN', KEYS[3]) >= tonumber(ARGV[2]) then
+    return {BACKLOG_FULL}
+end
+local remain = string.byte(redis.call('GETRANGE', KEYS[1], {gamecodec.REMAIN_OFFSET}, {gamecodec.REMAIN_OFFSET}))
+local guesses = {gamecodec.GUESSES} - remain
+if guesses < 1 then
+    return {NO_GUESSES}
+end
+redis.call('SETRANGE', KEYS[1], {gamecodec.REMAIN_OFFSET}, string.char(0))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[1])
+redis.call('XADD', KEYS[3], '*', 'user_id', ARGV[3], 'game_id', ARGV[4], 'finished', ARGV[5],
+           'guesses', guesses, 'won', ARGV[6])
+return redis.call('GET', KEYS[1])
+""")
+
+def game_key(user_id, game_id):
+    return str(user_id) + str(game_id)
+
+def finished_key(user_id, game_id):
+    return game_key(user_id, game_id) + ":finished"
+
+# Rewrite a game saved in an older format in the packed one, keeping its
+# expiry. Returns False if the game no longer exists or cannot be converted.
+def migrate_game(key):
+    with client_redis.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                kind = pipe.type(key)
+                if kind == b'hash':
+                    game = gamecodec.from_legacy(pipe.hgetall(key))
+                elif kind == b'string':
+                    value = pipe.get(key)
+                    if gamecodec.is_packed(value):
+                        return True
+                    game = gamecodec.from_legacy(value)
+                else:
+                    return False
+                ttl = pipe.ttl(key)
+                pipe.multi()
+                pipe.set(key, gamecodec.encode(game), ex=ttl if ttl > 0 else settings.game_ttl)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
+            except gamecodec.CodecError as e:
+                get_logger().error("Cannot convert game %s to the packed format: %s", key, e)
+                return False
+
+# Game ids are stored in four bytes by gamecodec.py
+def check_game_id(game_id):
+    if not 0 <= game_id <= gamecodec.MAX_GAME_ID:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Game id out of range"
+        )
+
+def run_game_script(script, key, args, other_keys=()):
+    keys = [key, *other_keys]
+    result = script(keys=keys, args=args)
+    if result == LEGACY_GAME:
+        get_logger().debug("Converting game %s to the packed format", key)
+        if not migrate_game(key):
+            return GAME_NOT_FOUND
+        result = script(keys=keys, args=args)
+    return result
 
 # Start a new game
 @app.post("/start", status_code=status.HTTP_201_CREATED)
 def start_game(
     username: str,
     game_id: int,
-    user_db: sqlite3.Connection = Depends(get_user_db),
-    game1_db: sqlite3.Connection = Depends(get_game1_db),
-    game2_db: sqlite3.Connection = Depends(get_game2_db),
-    game3_db: sqlite3.Connection = Depends(get_game3_db)
 ):
-    # Check if user_id is valid in user_db
-    #user_id = uuid.UUID(user_id)
-    # Check whether user_id exists in the user database or not
-    player = user_db.execute("SELECT * FROM users WHERE username = ?",[username]).fetchall()
-    if not player:
+    check_game_id(game_id)
+
+    # Check whether the user exists, through the user directory
+    user_id = users.user_id(username)
+    if user_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Player not found"
         )
-    for play in player:
-      user_id = play[0]
-
 
     # If the user has already played the game, they should receive an error.
-    # Choose the correct shard for this user_id
-    if int(user_id) % 3 == 1:
-        db = game1_db
-    elif int(user_id) % 3 == 2:
-        db = game2_db
-    else:
-        db = game3_db
-
-    game = db.execute("SELECT * FROM games WHERE user_id = ? AND game_id = ?", [user_id, game_id]).fetchall()
-    if game:
+    # Ask the bloom filter of the user's shard first, and read only that
+    # shard, or its replica, when it cannot rule the game out. Games finished
+    # but not yet written to the shard are caught by their finished marker below.
+    if may_have_played(user_id, game_id):
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT, detail="User already played this game"
         )
 
-    # Start a new game and save its state in redis db
-    new_game_key = str(user_id) + str(game_id)
-
-    # Check if this game is already in progress
-    current_game = client_redis.get(new_game_key)
-    if current_game:
+    # Start a new game and save its state in redis db,
+    # unless this game is already in progress
+    new_game = {"user_id" : str(user_id), "game_id" : game_id, "guess1" : None, "guess2" : None, 'guess3' : None, 'guess4' : None, 'guess5' : None, 'guess6' : None, "remain_guess" : 6}
+    if not client_redis.set(game_key(user_id, game_id), gamecodec.encode(new_game), nx=True, ex=settings.game_ttl):
+        # A finished game stays in redis until it expires, while it may still
+        # be waiting to be written to the shard
+        if client_redis.exists(finished_key(user_id, game_id)):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT, detail="User already played this game"
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Game in progress"
         )
 
-    new_game = {"user_id" : str(user_id), "game_id" : game_id, "guess1" : None, "guess2" : None, 'guess3' : None, 'guess4' : None, 'guess5' : None, 'guess6' : None, "remain_guess" : 6}
-    client_redis.set(new_game_key, json.dumps(new_game))
-
     return new_game
 
 # Update the state of a game
@@ -112,34 +333,32 @@ def update_game(
     game_id: int,
     guess: str,
 ):
-    game_key = user_id + str(game_id)
-    current_game = client_redis.get(game_key)
+    check_game_id(game_id)
 
-    # Check if this game exists
-    if not current_game:
+    # Each guess fills a five letter slot
+    if len(guess) != gamecodec.SLOT_SIZE or not guess.isascii() or not guess.isalpha():
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Guess must be five letters"
         )
 
-    current_game = json.loads(current_game.decode('utf-8'))
-    remain_guess = current_game['remain_guess']
+    # Record the guess and update the number of guesses remaining
+    # in one round trip
+    current_game = run_game_script(update_script, game_key(user_id, game_id), [settings.game_ttl, guess.lower()])
 
+    # Check if this game exists
+    if current_game == GAME_NOT_FOUND:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
+        )
 
-    if remain_guess < 1:
-        # If a user tries to guess more than
-        # six times, they should receive an error.
+    # If a user tries to guess more than
+    # six times, they should receive an error.
+    if current_game == GUESS_LIMIT:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Request exceeded allowed guess limit"
         )
-    else:
-        # When a user makes a new guess for a game,
-        # record the guess and update the number of guesses remaining.
-        guess_num = 6 - remain_guess + 1
-        current_game[f'guess{str(guess_num)}'] = guess
-        current_game['remain_guess'] = remain_guess - 1
-        client_redis.set(game_key, json.dumps(current_game))
 
-    return current_game
+    return gamecodec.decode(current_game)
 
 # Restoring the state of a game.
 @app.get("/restore")
@@ -147,14 +366,53 @@ def retrieve_game(
     user_id: str,
     game_id: int,
 ):
-    game_key = user_id + str(game_id)
-    restore_game = client_redis.get(game_key)
+    restore_game = run_game_script(restore_script, game_key(user_id, game_id), [])
 
     # Check if this game exists
-    if not restore_game:
+    if restore_game == GAME_NOT_FOUND:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
         )
-    restore_game = json.loads(restore_game.decode('utf-8'))
 
-    return restore_game
+    return gamecodec.decode(restore_game)
+
+# End a game that was won or ran out of guesses. No more guesses are accepted
+# and the game is queued for ./writebehind.py to record in the user's shard.
+@app.post("/finish")
+def finish_game(
+    user_id: str,
+    game_id: int,
+    won: bool,
+):
+    check_game_id(game_id)
+    try:
+        user_id = uuid.UUID(user_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
+        )
+    shard = router.shard_for(user_id)
+    finished_game = run_game_script(
+        finish_script,
+        game_key(user_id, game_id),
+        [settings.game_ttl, settings.writebehind_max_backlog, str(user_id), game_id,
+         datetime.date.today().isoformat(), int(won)],
+        [finished_key(user_id, game_id), writebehind.stream_key(shard)],
+    )
+
+    if finished_game == GAME_NOT_FOUND:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Game not found"
+        )
+    if finished_game == NO_GUESSES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Game has no guesses"
+        )
+    if finished_game == BACKLOG_FULL:
+        get_logger().warning("Write-behind backlog for shard %d is full", shard)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many games waiting to be recorded",
+            headers={"Retry-After": "1"},
+        )
+
+    return gamecodec.decode(finished_game)
@@ -0,0 +1,148 @@
+# Cached lookups of users.db, shared by the services.
+# users.db is only written when users are created, so usernames and user ids
+# are cached in both directions in bounded LRUs with a TTL, and unknown users
+# are remembered for a shorter time so repeated bad requests skip SQLite too.
+# Whatever creates users publishes on CHANNEL, and every directory listening
+# drops the affected entries.
+import collections
+import threading
+import uuid
+
+import cache
+import dbpool
+
+CHANNEL = "users:invalidate"
+
+# Published to drop every entry, e.g. after users.db is rebuilt
+ALL = "*"
+
+# SQLite limits the number of parameters in one statement
+BATCH_SIZE = 500
+
+
+def publish_invalidation(client_redis, *keys):
+    pipe = client_redis.pipeline(transaction=False)
+    for key in keys or [ALL]:
+        pipe.publish(CHANNEL, str(key))
+    pipe.execute()
+
+
+class UserDirectory:
+    def __init__(self, database, client_redis=None, maxsize=100000, ttl=3600.0, negative_ttl=60.0):
+        self.database = database
+        self.client_redis = client_redis
+        self.negative_ttl = negative_ttl
+        self._ids = cache.LRUCache(maxsize, ttl)
+        self._usernames = cache.LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._thread = None
+        self.counters = collections.Counter()
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _remember(self, user_id, username):
+        self._ids.set(username, user_id)
+        self._usernames.set(user_id, username)
+
+    # Cached value of key in lru, or the column of the matching users row
+    def _lookup(self, lru, key, sql, column):
+        found, value = lru.lookup(key)
+        if found:
+            self._count("hits" if value is not None else "negative_hits")
+            return value
+
+        self._count("misses")
+        with dbpool.connection(self.database) as db:
+            row = db.execute(sql, [key]).fetchone()
+        if row is None:
+            lru.set(key, None, ttl=self.negative_ttl)
+            return None
+        self._remember(row["user_id"], row["username"])
+        return row[column]
+
+    # The user id for a username, or None if there is no such user
+    def user_id(self, username):
+        return self._lookup(self._ids, username, "SELECT user_id, username FROM users WHERE username = ?", "user_id")
+
+    # The username for a user id, or None if there is no such user
+    def username(self, user_id):
+        if not isinstance(user_id, uuid.UUID):
+            user_id = uuid.UUID(str(user_id))
+        return self._lookup(self._usernames, user_id, "SELECT user_id, username FROM users WHERE user_id = ?", "username")
+
+    # Usernames for many user ids, with the uncached ones read in batches.
+    # Unknown users are left out.
+    def usernames(self, user_ids):
+        usernames = {}
+        missing = []
+        for user_id in user_ids:
+            found, username = self._usernames.lookup(user_id)
+            if found:
+                self._count("hits" if username is not None else "negative_hits")
+                if username is not None:
+                    usernames[user_id] = username
+            else:
+                missing.append(user_id)
+
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            self._count("misses")
+            placeholders = ", ".join("?" * len(batch))
+            with dbpool.connection(self.database) as db:
+                rows = db.execute(f"SELECT user_id, username FROM users WHERE user_id IN ({placeholders})", batch).fetchall()
+            for row in rows:
+                self._remember(row["user_id"], row["username"])
+                usernames[row["user_id"]] = row["username"]
+            for user_id in batch:
+                if user_id not in usernames:
+                    self._usernames.set(user_id, None, ttl=self.negative_ttl)
+        return usernames
+
+    def invalidate(self, key):
+        if key == ALL:
+            self._ids.clear()
+            self._usernames.clear()
+            return
+        self._ids.delete(key)
+        try:
+            self._usernames.delete(uuid.UUID(key))
+        except ValueError:
+            pass
+
+    def _on_invalidate(self, message):
+        key = message['data']
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        self._count("invalidations")
+        self.invalidate(key)
+
+    # Listen for users being created
+    def start(self):
+        if self.client_redis is None:
+            return
+        self._pubsub = self.client_redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{CHANNEL: self._on_invalidate})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "hits": counters.get("hits", 0),
+            "negative_hits": counters.get("negative_hits", 0),
+            "misses": counters.get("misses", 0),
+            "invalidations": counters.get("invalidations", 0),
+            "usernames": len(self._ids),
+            "user_ids": len(self._usernames),
+        }
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Per-user summary of finished games, kept in each games shard next to the
+# games table. insert_new_game updates a user's row as each game is recorded,
+# so their statistics are a single primary key read instead of scans of games.
+# Streaks come from the streak index (streakindex.py) in the same shard.
+#
+# Run this file to (re)build the summary from the games already in the shards:
+#
+#     ./userstats.py [./var/games1.db ...]
+import sqlite3
+import sys
+import uuid
+
+import shardrouter
+import streakindex
+
+sqlite3.register_converter('GUID', lambda b: uuid.UUID(bytes_le=b))
+sqlite3.register_adapter(uuid.UUID, lambda u: memoryview(u.bytes_le))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user_stats(
+    user_id GUID PRIMARY KEY,
+    played INTEGER NOT NULL DEFAULT 0,
+    won INTEGER NOT NULL DEFAULT 0,
+    guess1 INTEGER NOT NULL DEFAULT 0,
+    guess2 INTEGER NOT NULL DEFAULT 0,
+    guess3 INTEGER NOT NULL DEFAULT 0,
+    guess4 INTEGER NOT NULL DEFAULT 0,
+    guess5 INTEGER NOT NULL DEFAULT 0,
+    guess6 INTEGER NOT NULL DEFAULT 0,
+    fail INTEGER NOT NULL DEFAULT 0,
+    guess_total INTEGER NOT NULL DEFAULT 0,
+    current_streak INTEGER NOT NULL DEFAULT 0,
+    max_streak INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+COLUMNS = ['user_id', 'played', 'won', 'guess1', 'guess2', 'guess3', 'guess4', 'guess5', 'guess6',
+           'fail', 'guess_total', 'current_streak', 'max_streak']
+
+EMPTY = dict.fromkeys(COLUMNS, 0)
+
+
+def create_table(db):
+    db.executescript(SCHEMA)
+    streakindex.create_table(db)
+
+
+def save(db, stats):
+    db.execute(
+        f"INSERT OR REPLACE INTO user_stats({', '.join(COLUMNS)}) "
+        f"VALUES({', '.join(':' + c for c in COLUMNS)})",
+        stats
+    )
+
+
+def get(db, user_id):
+    row = db.execute(f"SELECT {', '.join(COLUMNS)} FROM user_stats WHERE user_id = ?", [user_id]).fetchone()
+    if not row:
+        return dict(EMPTY, user_id=user_id)
+    return dict(zip(COLUMNS, row))
+
+
+# Insert a finished game and fold it into the user's summary. Must be called
+# inside the transaction that commits the game. Returns the updated summary.
+def record_game(db, game):
+    db.execute(
+        """
+        INSERT INTO games(user_id, game_id, finished, guesses, won)
+        VALUES(:user_id, :game_id, :finished, :guesses, :won)
+        """,
+        game
+    )
+    stats = get(db, game['user_id'])
+
+    stats['played'] += 1
+    stats['guess_total'] += game['guesses']
+    if game['won']:
+        stats['won'] += 1
+        stats[f"guess{game['guesses']}"] += 1
+        length = streakindex.add_win(db, game['user_id'], game['finished'])
+        # A win reported out of date order rebuilds the user's runs, after
+        # which both streaks are read back from the index
+        if length is None:
+            stats['current_streak'] = streakindex.current_streak(db, game['user_id'])
+            stats['max_streak'] = streakindex.max_streak(db, game['user_id'])
+        elif length > 1:
+            stats['current_streak'] = length
+            stats['max_streak'] = max(stats['max_streak'], length)
+    else:
+        stats['fail'] += 1
+    save(db, stats)
+    return stats
+
+
+# Rebuild the summary and streak index for one user, or for every user in the shard
+def rebuild(db, user_id=None):
+    where, params = ("WHERE user_id = ?", [user_id]) if user_id is not None else ("", [])
+    db.execute(f"DELETE FROM user_stats {where}", params)
+    db.execute(
+        f"""
+        INSERT INTO user_stats({', '.join(COLUMNS[:11])})
+        SELECT
+            user_id,
+            COUNT(*),
+            SUM(won != 0),
+            SUM(won != 0 AND guesses = 1),
+            SUM(won != 0 AND guesses = 2),
+            SUM(won != 0 AND guesses = 3),
+            SUM(won != 0 AND guesses = 4),
+            SUM(won != 0 AND guesses = 5),
+            SUM(won != 0 AND guesses = 6),
+            SUM(won = 0),
+            SUM(guesses)
+        FROM games {where}
+        GROUP BY user_id
+        """,
+        params
+    )
+
+    streakindex.rebuild(db, user_id)
+    db.execute(
+        f"""
+        UPDATE user_stats SET
+            current_streak = IFNULL((
+                SELECT length FROM streak_runs
+                WHERE streak_runs.user_id = user_stats.user_id AND length > 1
+                ORDER BY ending DESC LIMIT 1
+            ), 0),
+            max_streak = IFNULL((
+                SELECT MAX(length) FROM streak_runs
+                WHERE streak_runs.user_id = user_stats.user_id AND length > 1
+            ), 0)
+        {where}
+        """,
+        params
+    )
+
+
+# Render a summary the way /users/{user_id} returns it
+def to_response(stats):
+    played = stats['played']
+    guess_record = {f'{n}': stats[f'guess{n}'] for n in range(1, 7)}
+    guess_record['fail'] = stats['fail']
+    return {
+        "currentStreak": stats['current_streak'],
+        "maxStreak": stats['max_streak'],
+        "guesses": guess_record,
+        "winPercentage": round((stats['won'] / played) * 100) if played else 0,
+        "gamesPlayed": played,
+        "gamesWon": stats['won'],
+        "averageGuesses": round(stats['guess_total'] / played) if played else 0,
+    }
+
+
+def backfill(database):
+    connection = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
+    create_table(connection)
+    rebuild(connection)
+    connection.commit()
+    count = connection.execute("SELECT COUNT(*) FROM user_stats").fetchone()[0]
+    connection.close()
+    return count
+
+
+def main():
+    shards = sys.argv[1:] or shardrouter.from_env().databases
+    for shard in shards:
+        print(f"Building user statistics for {shard}...")
+        print(f"{backfill(shard)} users summarized\n")
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ import sqlite3
 from fastapi import FastAPI, Depends, HTTPException, status
 from pydantic import BaseSettings
 
+import instrument
+
 
 class Settings(BaseSettings):
     word_database: str
@@ -26,17 +28,25 @@ def get_logger():
 
 settings = Settings()
 app = FastAPI(root_path="/dict")
+instrument.instrument(app)
+
+instrument.configure_logging(settings.logging_config)
 
-logging.config.fileConfig(settings.logging_config)
+# In-memory index of the dictionary, loaded once and kept in sync
+# by /add_guess and /remove_guess
+dictionary = set()
+
+@app.on_event("startup")
+def load_dictionary():
+    with contextlib.closing(sqlite3.connect(settings.word_database)) as db:
+        dictionary.clear()
+        dictionary.update(row[0] for row in db.execute("SELECT word FROM words"))
+    get_logger().info("Loaded %d words into the dictionary index", len(dictionary))
 
 @app.get("/validate")
 def validate_guess(
-    guess : str,
-    db: sqlite3.Connection = Depends(get_db)
+    guess : str
 ):
-    cur = db.execute("SELECT * FROM words WHERE word = ?", [guess])
-    words = cur.fetchall()
-
     if len(guess) != 5:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=f"{guess} not five letters."
@@ -45,15 +55,12 @@ def validate_guess(
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=f"{guess} not entirely letters."
         )
-    elif not words:
+    elif guess not in dictionary:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=f"{guess} not found in dictionary."
         )
 
-    valid_guess = ""
-    for word in words:
-        valid_guess = word['word']
-    return {"response": f"{valid_guess} is valid"}
+    return {"response": f"{guess} is valid"}
 
 @app.post("/add_guess", status_code=status.HTTP_201_CREATED)
 def add_word(
@@ -69,6 +76,7 @@ def add_word(
             detail={"type": type(e).__name__, "msg": str(e)},
         )
 
+    dictionary.add(guess)
     new_word_id = cur.lastrowid
     return {"id": f"{new_word_id}", "word": f"{guess}"}
 
@@ -87,4 +95,5 @@ def remove_word(
 
     cur =  db.execute("DELETE FROM words WHERE word = ?", [guess])
     db.commit()
+    dictionary.discard(guess)
     return {"response": f"Successfully removed {guess}"}
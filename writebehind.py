@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# Write-behind of finished games into the games shards.
+# trackgamestate.py appends each finished game to the stream of its user's
+# shard (games:finished:<shard>) instead of writing SQLite in the request.
+# This worker reads every stream in a consumer group, one thread per shard,
+# and records each batch of games in a single transaction before
+# acknowledging and deleting the entries. Games are written at least once:
+# entries read by a worker that stopped before acknowledging them are claimed
+# by another after --claim-after seconds, and a game already in the shard is
+# skipped, so replaying a batch changes nothing.
+#
+# trackgamestate stops accepting finished games while a stream holds
+# WRITEBEHIND_MAX_BACKLOG entries, and reports the backlog and the age of the
+# oldest entry on /metrics. The worker reports what it wrote and how long
+# games waited on its own /metrics port. Each batch is added to the shard's
+# bloom filter (bloom.py) before it is acknowledged, so a failed update is
+# retried with the batch:
+#
+#     ./writebehind.py [--shard N ...] [--batch-size 500] [--consumer NAME] [--metrics-port 9100]
+import argparse
+import datetime
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import redis
+
+import bloom
+import cache
+import instrument
+import leaderboards
+import shardrouter
+import userdir
+import userstats
+
+GROUP = "writers"
+
+games_written = instrument.Counter(
+    "writebehind_games_total", "Finished games taken from the streams by result", ("shard", "result")
+)
+batch_seconds = instrument.Histogram(
+    "writebehind_batch_duration_seconds", "Time to record one batch in its shard", ("shard",)
+)
+lag_seconds = instrument.Histogram(
+    "writebehind_lag_seconds", "Time from a game finishing to its commit in the shard", ("shard",),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+
+
+def get_logger():
+    return logging.getLogger(__name__)
+
+
+def stream_key(shard):
+    return f"games:finished:{shard}"
+
+
+def entry_time(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('ascii')
+    return int(entry_id.split('-')[0]) / 1000
+
+
+# Entries waiting in each shard's stream, read or not, and the age of the
+# oldest in seconds
+def backlog(client_redis, shards):
+    pipe = client_redis.pipeline(transaction=False)
+    for shard in shards:
+        pipe.xlen(stream_key(shard))
+        pipe.xrange(stream_key(shard), count=1)
+    results = pipe.execute()
+    now = time.time()
+    return {
+        shard: (length, now - entry_time(oldest[0][0]) if oldest else 0.0)
+        for shard, length, oldest in zip(shards, results[::2], results[1::2])
+    }
+
+
+def parse_entry(fields):
+    fields = {k.decode('utf-8'): v.decode('utf-8') for k, v in fields.items()}
+    return {
+        "user_id": uuid.UUID(fields["user_id"]),
+        "game_id": int(fields["game_id"]),
+        "finished": datetime.date.fromisoformat(fields["finished"]),
+        "guesses": int(fields["guesses"]),
+        "won": fields["won"] == "1",
+    }
+
+
+# Record games in date order, skipping those already in the shard, and
+# commit once. Returns the summaries of the players with new games and the
+# games recorded.
+def write_batch(db, games):
+    players = {}
+    recorded = []
+    for game in sorted(games, key=lambda game: game["finished"]):
+        try:
+            players[game["user_id"]] = userstats.record_game(db, game)
+            recorded.append(game)
+        except sqlite3.IntegrityError:
+            continue
+    db.commit()
+    return players, recorded
+
+
+class ShardWriter:
+    def __init__(self, shard, database, client_redis, users, stats_cache, bloom_filter, consumer,
+                 batch_size=500, block_ms=1000, claim_after=30.0):
+        self.shard = shard
+        self.database = database
+        self.client_redis = client_redis
+        self.users = users
+        self.stats_cache = stats_cache
+        self.bloom_filter = bloom_filter
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_after = claim_after
+        self.key = stream_key(shard)
+        self.db = None
+
+    def create_group(self):
+        try:
+            self.client_redis.xgroup_create(self.key, GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    # Entries deleted while pending come back without fields. They are
+    # acknowledged so they leave the pending list, and never written.
+    def discard_deleted(self, entries):
+        deleted = [entry_id for entry_id, fields in entries if not fields]
+        if deleted:
+            self.client_redis.xack(self.key, GROUP, *deleted)
+            get_logger().warning("Acknowledged %d deleted entries in %s", len(deleted), self.key)
+        return [(entry_id, fields) for entry_id, fields in entries if fields]
+
+    # Entries this consumer read before it last stopped, then entries other
+    # consumers left unacknowledged for too long, then new entries
+    def read(self):
+        while True:
+            entries = self.client_redis.xreadgroup(GROUP, self.consumer, {self.key: "0"}, count=self.batch_size)
+            if not entries or not entries[0][1]:
+                break
+            pending = self.discard_deleted(entries[0][1])
+            if pending:
+                return pending
+        _, claimed, *_ = self.client_redis.xautoclaim(
+            self.key, GROUP, self.consumer, int(self.claim_after * 1000), "0-0", count=self.batch_size
+        )
+        claimed = self.discard_deleted(claimed)
+        if claimed:
+            return claimed
+        entries = self.client_redis.xreadgroup(
+            GROUP, self.consumer, {self.key: ">"}, count=self.batch_size, block=self.block_ms
+        )
+        return entries[0][1] if entries else []
+
+    def write(self, entries):
+        games = []
+        for entry_id, fields in entries:
+            try:
+                games.append(parse_entry(fields))
+            except (AttributeError, KeyError, TypeError, ValueError):
+                get_logger().error("Dropping malformed entry %s in %s: %r", entry_id, self.key, fields)
+
+        start = time.perf_counter()
+        players, recorded = write_batch(self.db, games)
+        committed = time.time()
+        batch_seconds.observe(time.perf_counter() - start, str(self.shard))
+        for entry_id, _ in entries:
+            lag_seconds.observe(committed - entry_time(entry_id), str(self.shard))
+
+        # Games skipped as already written are added too, in case the batch
+        # is being replayed after the filter update failed
+        self.bloom_filter.add([(game["user_id"], game["game_id"]) for game in games])
+
+        ids = [entry_id for entry_id, _ in entries]
+        pipe = self.client_redis.pipeline(transaction=True)
+        pipe.xack(self.key, GROUP, *ids)
+        pipe.xdel(self.key, *ids)
+        pipe.execute()
+
+        games_written.inc(str(self.shard), "inserted", amount=len(recorded))
+        games_written.inc(str(self.shard), "duplicate", amount=len(games) - len(recorded))
+        if recorded:
+            self.publish(players, recorded)
+        return len(recorded)
+
+    # The same cache invalidation and leaderboard updates as statistics.py
+    # makes for games posted to it. Failures are logged; the cached
+    # statistics expire and ./leaderboards.py repairs the boards.
+    def publish(self, players, recorded):
+        try:
+            self.stats_cache.invalidate(*(str(user_id) for user_id in players))
+            usernames = self.users.usernames(set(players))
+            leaderboards.update_players(
+                self.client_redis,
+                {usernames[user_id]: stats for user_id, stats in players.items() if user_id in usernames},
+                [(usernames[game["user_id"]], game["finished"]) for game in recorded
+                 if game["won"] and game["user_id"] in usernames],
+            )
+        except redis.RedisError:
+            get_logger().exception("Could not update statistics caches for shard %d", self.shard)
+
+    def run(self, stop):
+        self.db = shardrouter.connect(self.database)
+        self.create_group()
+        while not stop.is_set():
+            try:
+                entries = self.read()
+                if entries:
+                    written = self.write(entries)
+                    get_logger().debug("Wrote %d of %d games to shard %d", written, len(entries), self.shard)
+            except (redis.RedisError, sqlite3.Error):
+                get_logger().exception("Write-behind to shard %d failed, retrying", self.shard)
+                self.db.rollback()
+                stop.wait(1.0)
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write finished games from the Redis streams into the shards")
+    parser.add_argument('--shard', type=int, action='append', help="shards to drain (default: all)")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--block-ms', type=int, default=1000, help="wait for new games for this long")
+    parser.add_argument('--claim-after', type=float, default=30.0,
+                        help="take over entries left unacknowledged for this many seconds")
+    parser.add_argument('--consumer', default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument('--users', default=os.environ.get('USER_DATABASE', './var/users.db'))
+    parser.add_argument('--metrics-port', type=int)
+    parser.add_argument('--logging-config', default=os.environ.get('LOGGING_CONFIG', './etc/logging.ini'))
+    args = parser.parse_args()
+
+    instrument.configure_logging(args.logging_config)
+    if args.metrics_port:
+        instrument.serve_metrics(args.metrics_port)
+
+    client_redis = instrument.instrument_redis(redis.Redis())
+    router = shardrouter.from_env()
+    users = userdir.UserDirectory(args.users, client_redis)
+    stats_cache = cache.ResponseCache(client_redis, "stats:users")
+    bloom_filters = bloom.from_env(client_redis, router)
+    users.start()
+
+    stop = threading.Event()
+    threads = []
+    for shard in args.shard or router.shards:
+        writer = ShardWriter(
+            shard, router.databases[shard - 1], client_redis, users, stats_cache, bloom_filters[shard], args.consumer,
+            args.batch_size, args.block_ms, args.claim_after,
+        )
+        threads.append(threading.Thread(target=writer.run, args=(stop,), name=f"shard{shard}"))
+    for thread in threads:
+        thread.start()
+
+    print(f"Writing finished games to {len(threads)} shards as {args.consumer}")
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    users.stop()
+
+if __name__ == '__main__':
+    main()